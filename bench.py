@@ -0,0 +1,259 @@
+# bench.py — 오프라인 벤치마크/부하 테스트 (AppTest + 가짜 LLM)
+# 실행: python bench.py [--latency 0.2 --sessions 4 ...] [--out bench.json]
+# 결과는 JSON 1개(stdout 또는 --out). 배포 전 이전 결과와 비교해 회귀를 잡는 용도.
+
+import os, sys, json, time, random, argparse, tempfile, tracemalloc, logging, platform, subprocess, threading
+import multiprocessing as mp
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+TABS = {"home": "🏠 홈", "pay": "💳 결제", "goal": "🎯 목표", "calendar": "📅 일정", "insight": "📊 분석"}
+
+def stats(samples):
+    s = sorted(samples)
+    if not s: return {}
+    pick = lambda q: s[min(len(s)-1, int(q*len(s)))]
+    return {"n": len(s), "mean_ms": round(1000*sum(s)/len(s), 2), "p50_ms": round(1000*pick(.5), 2),
+            "p95_ms": round(1000*pick(.95), 2), "max_ms": round(1000*s[-1], 2)}
+
+def timed(fn):
+    t0 = time.perf_counter(); fn(); return time.perf_counter() - t0
+
+# ------------------ AppTest 드라이버 ------------------
+SCRIPT_ERRORS = []   # 러너가 로그로만 남기거나 러너 스레드에서 터진 오류(at.exception엔 안 잡힘)
+
+class _ErrorLog(logging.Handler):
+    def emit(self, record): SCRIPT_ERRORS.append(record.getMessage())
+
+def watch_runner():
+    """스크립트 러너 오류 로그 + 스레드 예외를 SCRIPT_ERRORS에 모음(프로세스당 1회)."""
+    if getattr(watch_runner, "done", False): return
+    # streamlit 로거는 propagate=False → 러너 로거에 직접 부착
+    logging.getLogger("streamlit.runtime.scriptrunner.script_runner").addHandler(_ErrorLog(logging.ERROR))
+    hook = threading.excepthook
+    def on_thread_error(args):
+        SCRIPT_ERRORS.append(f"{args.exc_type.__name__}: {args.exc_value}"); hook(args)
+    threading.excepthook = on_thread_error
+    watch_runner.done = True
+
+def new_app():
+    from streamlit.testing.v1 import AppTest
+    watch_runner()
+    at = AppTest.from_file(APP, default_timeout=120)
+    at.run(); check(at)
+    return at
+
+def check(at):
+    """예외·러너 오류·빈 화면 리런은 실패 처리 → 잘못된 샘플이 통계에 섞이지 않게."""
+    if at.exception: raise RuntimeError(f"앱 예외: {at.exception}")
+    if SCRIPT_ERRORS:
+        err = SCRIPT_ERRORS[0]; SCRIPT_ERRORS.clear()
+        raise RuntimeError(f"스크립트 러너 오류: {err}")
+    if not len(at.main) and not len(at.sidebar): raise RuntimeError("빈 화면 렌더(트리 비어 있음)")
+
+def find(at, elems, label):
+    """키 있는 조각만 다시 실행된 뒤엔 AppTest 트리에 마지막 조각만 남음 → 없으면 전체 리런으로 트리 갱신(측정 제외)."""
+    hit = [x for x in elems(at) if x.label == label]
+    if not hit:
+        at.run(); check(at); hit = [x for x in elems(at) if x.label == label]
+    return hit[0]
+
+def click(at, label):
+    """버튼 클릭 리런 1회의 소요 시간."""
+    b = find(at, lambda a: a.button, label)
+    return timed(lambda: (b.click(), at.run(), check(at)))
+
+def send(at, text):
+    find(at, lambda a: a.text_input, "메시지").set_value(text)
+    return click(at, "보내기")
+
+def bench_tabs(reruns):
+    """탭별 리런 지연: 탭으로 이동한 뒤 같은 탭에서 리런 반복(첫 진입은 제외)."""
+    at, out = new_app(), {}
+    for tab, label in TABS.items():
+        click(at, label)
+        out[tab] = stats([timed(at.run) for _ in range(reruns)])
+    return out
+
+CHAT_PROMPTS = ["카드 한도 얼마 남았어?", "이번달 예산 요약해줘", "스타커피 결제 추천", "왜 이용률이 올랐어?", "목표 달성 가능할까"]
+
+def bench_chat(turns):
+    at = new_app()
+    return stats([send(at, f"{CHAT_PROMPTS[i % len(CHAT_PROMPTS)]} #{i}") for i in range(turns)])
+
+def bench_history(sizes):
+    """대화 기록 길이별 리런 지연 + 파이썬 힙 증가(tracemalloc)."""
+    at, out = new_app(), []
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for n in sizes:
+        at.session_state["msgs"] = [("user" if i % 2 else "bot", f"기록 메시지 {i} " + "가"*40) for i in range(n)]
+        at.run(); check(at)
+        lat = stats([timed(at.run) for _ in range(3)])
+        cur, peak = tracemalloc.get_traced_memory()
+        out.append({"msgs": n, "kept": len(at.session_state["msgs"]), "rerun": lat,
+                    "heap_growth_kb": round((cur - base)/1024), "heap_peak_kb": round(peak/1024)})
+    tracemalloc.stop()
+    return out
+
+def session_worker(k, reruns, go, q):
+    """세션 1개 = 프로세스 1개(AppTest는 프로세스 전역 런타임을 공유 → 스레드 동시 실행 불가)."""
+    logging.disable(logging.WARNING)
+    try:
+        at, lat = new_app(), []
+        go.wait(timeout=600)   # 전 세션 로드 후 동시 출발(앱 로드 시간 제외)
+        t0 = time.time()
+        for i in range(reruns):
+            lat.append(click(at, list(TABS.values())[(k + i) % len(TABS)]))
+        q.put((k, lat, t0, time.time(), None))
+    except Exception as e:
+        go.abort(); q.put((k, [], 0, 0, repr(e)))
+
+def bench_sessions(sessions, reruns):
+    """N개 세션을 별도 프로세스로 동시에 돌려 세션당 리런 지연과 전체 처리량 측정."""
+    ctx = mp.get_context("spawn")
+    go, q = ctx.Barrier(sessions), ctx.Queue()
+    procs = [ctx.Process(target=session_worker, args=(k, reruns, go, q), daemon=True) for k in range(sessions)]
+    for pr in procs: pr.start()
+    done = [q.get(timeout=1800) for _ in procs]
+    for pr in procs: pr.join()
+    errs = [f"세션 {k}: {e}" for k, _, _, _, e in done if e]
+    if errs: raise RuntimeError("; ".join(errs))
+    lat = [x for _, xs, _, _, _ in done for x in xs]
+    wall = max(d[3] for d in done) - min(d[2] for d in done)
+    return {"sessions": sessions, "rerun": stats(lat), "wall_s": round(wall, 3),
+            "reruns_per_s": round(len(lat)/wall, 2)}
+
+# ------------------ 콜드 스타트 ------------------
+STARTUP_CODE = ("import sys, time, logging; logging.disable(logging.WARNING); t = time.perf_counter(); "
+                "import streamlit_app; print(time.perf_counter() - t); "
+                "print(int('gtts' in sys.modules), int('google.generativeai' in sys.modules))")
+
+def bench_startup(runs, top=10):
+    """새 프로세스에서 앱을 bare import(키 없음)한 시간 + -X importtime 앱 직속 import별 누적 시간."""
+    env = {k: v for k, v in os.environ.items() if k not in ("COACH_FAKE_LLM", "GOOGLE_API_KEY")}
+    walls, mods, lazy = [], {}, None
+    for _ in range(runs):
+        p = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_CODE], cwd=os.path.dirname(APP),
+                           env=env, capture_output=True, text=True, timeout=300)
+        out = p.stdout.split()
+        walls.append(float(out[0])); lazy = {"gtts_loaded": out[1] == "1", "genai_loaded": out[2] == "1"}
+        for line in p.stderr.splitlines():
+            # "import time: self [us] | cumulative | name" — 이름 앞 공백 2칸당 중첩 1단계.
+            # 앱(깊이 0)이 직접 불러온 모듈(깊이 1)만 집계
+            parts = line[len("import time:"):].split("|") if line.startswith("import time:") else []
+            if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+            name = parts[2].strip()
+            if (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2 != 1: continue
+            mods[name] = max(mods.get(name, 0), int(parts[1]))
+    heavy = sorted(mods.items(), key=lambda kv: -kv[1])[:top]
+    return {"bare_import": stats(walls), **lazy, "top_imports_ms": {k: round(v/1000, 1) for k, v in heavy}}
+
+# ------------------ 순수 함수(bare import) ------------------
+def synth_cards(n, mccs, rng):
+    cards = []
+    for i in range(n):
+        mcc = ["ALL"] if i % 10 == 0 else rng.sample(mccs, k=min(3, len(mccs)))
+        cards.append({"name": f"Card{i:04d}", "mcc": mcc, "rate": rng.choice([.01, .02, .03, .05, .07, .1]),
+                      "cap": rng.choice([10_000, 20_000, 50_000]), "month_accum": rng.randrange(0, 10_000)})
+    return cards
+
+def bench_routing(app, cards_n, merchants_n, rows, iters):
+    import pandas as pd
+    rng = random.Random(7)
+    mccs = [f"M{i:03d}" for i in range(max(1, merchants_n // 5))]
+    cards = synth_cards(cards_n, mccs, rng)
+    merchants = {f"가맹점{i}": rng.choice(mccs) for i in range(merchants_n)}
+    names = list(merchants)
+
+    idx = app.CardIndex(cards)
+    queries = [(rng.randrange(1_000, 200_000), merchants[rng.choice(names)]) for _ in range(iters)]
+    t_top = timed(lambda: [idx.top(a, m, k=3) for a, m in queries])
+    t_est = timed(lambda: [app.estimate_saving(a, "CAFE") for a, _ in queries])   # 앱 포트폴리오 + 캐시 경로
+
+    days = pd.date_range(end=pd.Timestamp.today(), periods=90).strftime("%Y-%m-%d").tolist()
+    tx = pd.DataFrame([{"date": rng.choice(days), "merchant": m, "mcc": merchants[m], "amount": rng.randrange(1_000, 200_000)}
+                       for m in (rng.choice(names) for _ in range(rows))])
+    t_route = min(timed(lambda: app.route_batch(tx, cards)) for _ in range(3))
+    return {"cards": cards_n, "merchants": merchants_n,
+            "card_index_top_per_s": round(iters/t_top), "estimate_saving_per_s": round(iters/t_est),
+            "route_batch_rows": rows, "route_batch_ms": round(1000*t_route, 2), "route_batch_rows_per_s": round(rows/t_route)}
+
+def bench_snapshot(app, customers):
+    """상담사 대시보드: 고객 N명 스냅샷을 배열 연산 vs 고객별 객체 생성."""
+    import copy
+    rng, out = random.Random(11), []
+    for i in range(customers):
+        c = copy.deepcopy(app.SEED_CUSTOMER); c["profile"]["cust_id"] = f"BENCH{i:06d}"
+        for a in c["accounts"]:
+            if a["type"] == "신용카드": a["used"] = rng.randrange(0, a["limit"])
+            if a["type"] == "입출금": a["balance"] = rng.randrange(0, 2_000_000)
+        for v in c["budgets"].values(): v["spent"] = rng.randrange(0, int(v["limit"]*1.3))
+        out.append(c)
+    t_vec = min(timed(lambda: app.snapshot_frame(out)) for _ in range(3))
+    t_obj = timed(lambda: [app.FinancialSnapshot(c) for c in out])
+    return {"customers": customers, "vectorized_ms": round(1000*t_vec, 2), "per_customer_ms": round(1000*t_obj, 2)}
+
+def bench_goals(app, customers, paths):
+    """목표 몬테카를로: 단일 고객(캐시 미스/적중) + 고객 N명 일괄."""
+    import copy
+    rng, out = random.Random(13), []
+    for i in range(customers):
+        c = copy.deepcopy(app.SEED_CUSTOMER); c["profile"]["cust_id"] = f"BENCH{i:06d}"
+        c["goal"].update(months=rng.randint(1, 36), monthly=rng.randrange(50_000, 500_000, 10_000))
+        out.append(c)
+    base = app.goal_base(app.SEED_CUSTOMER, ())
+    t_one = stats([timed(lambda m=m: app.simulate_goal(2_000_000, m, 250_000, base)) for m in range(1, 25)])
+    app.goal_projection(2_000_000, 8, 250_000)
+    t_hit = stats([timed(lambda: app.goal_projection(2_000_000, 8, 250_000)) for _ in range(100)])
+    t_batch = timed(lambda: app.goal_frame(out, paths=paths))
+    return {"single_paths": app.GOAL_PATHS, "single": t_one, "cached": t_hit, "customers": customers,
+            "batch_paths": paths, "batch_ms": round(1000*t_batch, 2), "customers_per_s": round(customers/t_batch)}
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="아바타 금융 코치 오프라인 벤치마크")
+    p.add_argument("--latency", type=float, default=0.05, help="가짜 LLM 응답 지연(초)")
+    p.add_argument("--fail", type=float, default=0.0, help="가짜 LLM 실패 확률")
+    p.add_argument("--reruns", type=int, default=10, help="탭별 리런 반복 수")
+    p.add_argument("--turns", type=int, default=10, help="채팅 턴 수")
+    p.add_argument("--history", default="100,1000,5000", help="대화 기록 길이(쉼표 구분)")
+    p.add_argument("--sessions", type=int, default=4, help="동시 세션 수")
+    p.add_argument("--cards", type=int, default=200)
+    p.add_argument("--merchants", type=int, default=2000)
+    p.add_argument("--rows", type=int, default=50_000, help="route_batch 거래 행 수")
+    p.add_argument("--iters", type=int, default=20_000, help="estimate_saving 호출 수")
+    p.add_argument("--customers", type=int, default=10_000, help="스냅샷 일괄 계산 고객 수")
+    p.add_argument("--goal-customers", type=int, default=2000, help="목표 시뮬레이션 일괄 고객 수")
+    p.add_argument("--goal-paths", type=int, default=1000, help="일괄 시뮬레이션 고객당 경로 수")
+    p.add_argument("--startup-runs", type=int, default=3, help="콜드 스타트 측정 프로세스 수")
+    p.add_argument("--only", default="", help="일부만: startup,tabs,chat,history,sessions,routing,snapshot,goals")
+    p.add_argument("--out", help="JSON 저장 경로(없으면 stdout)")
+    a = p.parse_args(argv)
+
+    # 앱 import/AppTest 전에 환경 고정: 가짜 모델, 임시 데이터 폴더, 속도 제한 해제
+    os.environ["COACH_FAKE_LLM"] = f"latency={a.latency},fail={a.fail},seed=1"
+    os.environ["COACH_DATA_DIR"] = tempfile.mkdtemp(prefix="coach_bench_")
+    os.environ.setdefault("COACH_LLM_RPS", "1000"); os.environ.setdefault("COACH_LLM_BURST", "1000")
+    logging.disable(logging.WARNING)   # bare 모드 경고 억제
+    only = set(filter(None, a.only.split(","))) or {"startup", "tabs", "chat", "history", "sessions", "routing", "snapshot", "goals"}
+
+    res = {"meta": {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                    "args": vars(a)}}
+    if "startup" in only:  res["startup"] = bench_startup(a.startup_runs)
+    if "tabs" in only:     res["tabs"] = bench_tabs(a.reruns)
+    if "chat" in only:     res["chat"] = bench_chat(a.turns)
+    if "history" in only:  res["history"] = bench_history([int(x) for x in a.history.split(",")])
+    if "sessions" in only: res["sessions"] = bench_sessions(a.sessions, a.reruns)
+    if only & {"routing", "snapshot", "goals"}:
+        sys.path.insert(0, os.path.dirname(APP))
+        import streamlit_app as app
+        if "routing" in only:  res["routing"] = bench_routing(app, a.cards, a.merchants, a.rows, a.iters)
+        if "snapshot" in only: res["snapshot"] = bench_snapshot(app, a.customers)
+        if "goals" in only:    res["goals"] = bench_goals(app, a.goal_customers, a.goal_paths)
+
+    text = json.dumps(res, ensure_ascii=False, indent=2)
+    if a.out:
+        with open(a.out, "w", encoding="utf-8") as f: f.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()
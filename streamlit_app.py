@@ -1,21 +1,28 @@
 # streamlit_app.py — '폰' 단일화면 + (수정) 채팅 옆 원형 아바타 + 기존 기능(TTS/결제/목표/일정/용어/감사로그) 유지
 # 설치: pip install -U streamlit google-generativeai pillow pandas gTTS
 
-import os, io, json, time, base64, math, random, datetime
+import os, io, re, json, time, types, inspect, contextlib, logging, unicodedata, base64, math, random, datetime, hashlib, threading, sqlite3, heapq, difflib, uuid, copy, functools, bisect, queue, atexit
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import numpy as np
 import pandas as pd
-from PIL import Image, ImageDraw
-from gtts import gTTS
+from PIL import Image, ImageDraw, ImageOps
+# gtts·google.generativeai는 무거워서(각 ~0.1s·~0.9s) TTS를 켜거나 키가 있을 때만 함수 안에서 import
 
 PHONE_W = 430
 st.set_page_config(page_title="아바타 금융 코치", page_icon="📱", layout="centered")
 
 # ------------------ CSS ------------------
-st.markdown(f"""
+@st.cache_resource(show_spinner=False)
+def page_css(width:int)->str:
+    # 정적 스타일은 프로세스당 한 번만 조립, 리런마다 같은 문자열 재사용
+    return f"""
 <style>
 html, body {{ background:#0b0d12; }}
 .main .block-container {{
-  max-width:{PHONE_W}px; padding-top:10px; padding-bottom:12px;
+  max-width:{width}px; padding-top:10px; padding-bottom:12px;
   border:12px solid #101012; border-radius:30px; background:#0f1116;
   box-shadow:0 16px 40px rgba(0,0,0,.4);
 }}
@@ -28,7 +35,7 @@ html, body {{ background:#0b0d12; }}
 .label {{ color:#9fb3d2; font-size:.85rem; margin:.2rem 0 .45rem; }}
 
 /* 네비 */
-.navrow {{ display:grid; grid-template-columns:repeat(4,1fr); gap:8px; margin:6px 0 10px; }}
+.navrow {{ display:grid; grid-template-columns:repeat(5,1fr); gap:8px; margin:6px 0 10px; }}
 .navbtn {{ display:flex; align-items:center; justify-content:center; gap:.35rem;
           padding:.55rem .6rem; border-radius:12px; border:1px solid #2a2f3a;
           background:#121722; color:#e9eefc; font-size:.9rem; }}
@@ -84,7 +91,9 @@ html, body {{ background:#0b0d12; }}
 .smallnote {{ font-size:.78rem; color:#98a3bb; }}
 .badge {{ display:inline-block; padding:.22rem .5rem; border:1px solid #2a3558; border-radius:999px; margin-right:4px; font-size:.75rem; color:#dfe8ff; background:#141c33; }}
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(page_css(PHONE_W), unsafe_allow_html=True)
 
 # ------------------ 사이드 옵션 ------------------
 with st.sidebar:
@@ -103,103 +112,816 @@ with st.sidebar:
     avatar_up = st.file_uploader("아바타 이미지(선택)", type=["png","jpg","jpeg"])
     tts_on = st.toggle("봇 답변 음성(TTS) 재생", value=False)
     geo_sim = st.toggle("지오펜싱 결제추천(시뮬레이션)", value=False)
+    stream_on = st.toggle("답변 스트리밍(실시간 표시)", value=True)
     # 아바타 이름 바꾸기
     ss_name = st.session_state.get("avatar_name", "아바타 코치")
     st.session_state["avatar_name"] = st.text_input("아바타 이름", value=ss_name, max_chars=16)
 
-# ------------------ 안전한 업로드 → base64 ------------------
-def upload_to_b64(file):
-    if not file: return ""
+# ------------------ 성능 계측(스팬·히스토그램) ------------------
+TRACE_RERUNS = 20                           # 디버그 패널에 남길 최근 리런 수
+TRACE_FILE = os.getenv("COACH_TRACE_FILE")  # 지정 시 리런마다 JSONL 1줄 추가
+TRACE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)   # 초
+
+class Histogram:
+    """Prometheus용 버킷 카운트 + 백분위용 최근 샘플(고정 길이)."""
+    def __init__(self, keep=2048):
+        self.counts, self.sum, self.n = [0]*len(TRACE_BUCKETS), 0.0, 0
+        self.samples = deque(maxlen=keep)
+
+    def observe(self, sec:float):
+        self.sum += sec; self.n += 1; self.samples.append(sec)
+        i = bisect.bisect_left(TRACE_BUCKETS, sec)
+        if i < len(self.counts): self.counts[i] += 1
+
+    def percentiles(self, qs=(50, 95, 99)):
+        return dict(zip(qs, np.percentile(self.samples, qs))) if self.samples else {}
+
+class Tracer:
+    """프로세스 공용 단계별 지연 히스토그램 + LLM 토큰 집계."""
+    def __init__(self):
+        self.hist = defaultdict(Histogram)
+        self.tokens = defaultdict(lambda: [0, 0, 0])   # 단계 → [호출, 프롬프트, 응답]
+        self.local = threading.local()   # 스레드별 열린 스팬 스택(토큰을 어느 단계에 붙일지)
+        self._lock = threading.Lock()
+
+    def observe(self, stage:str, sec:float):
+        with self._lock: self.hist[stage].observe(sec)
+
+    def count_tokens(self, stage:str, prompt:int, response:int):
+        with self._lock:
+            t = self.tokens[stage]; t[0] += 1; t[1] += prompt; t[2] += response
+
+    def summary(self):
+        with self._lock:
+            rows = [{"단계": k, "n": h.n, **{f"p{q}(ms)": round(v*1000, 1) for q,v in h.percentiles().items()}}
+                    for k,h in sorted(self.hist.items())]
+            for r in rows:
+                n, p, o = self.tokens.get(r["단계"], (0, 0, 0))
+                if n: r["토큰(입/출)"] = f"{p//n}/{o//n}"
+        return rows
+
+    def prometheus(self)->str:
+        out = ["# TYPE coach_stage_seconds histogram"]
+        with self._lock:
+            for stage, h in sorted(self.hist.items()):
+                acc = 0
+                for le, c in zip(TRACE_BUCKETS, h.counts):
+                    acc += c; out.append(f'coach_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {acc}')
+                out += [f'coach_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.n}',
+                        f'coach_stage_seconds_sum{{stage="{stage}"}} {h.sum:.6f}',
+                        f'coach_stage_seconds_count{{stage="{stage}"}} {h.n}']
+            out.append("# TYPE coach_llm_tokens_total counter")
+            for stage, (_, p, o) in sorted(self.tokens.items()):
+                out += [f'coach_llm_tokens_total{{stage="{stage}",kind="prompt"}} {p}',
+                        f'coach_llm_tokens_total{{stage="{stage}",kind="response"}} {o}']
+        return "\n".join(out) + "\n"
+
+@st.cache_resource(show_spinner=False)
+def tracer():
+    return Tracer()
+
+def current_run():
+    try:
+        return st.session_state.get("trace_run")
+    except Exception:
+        return None
+
+def current_stage()->str:
+    # 스택은 캐시된 Tracer에 둠: 이전 리런에서 만든 게이트웨이도 같은 스택을 봄
+    stack = getattr(tracer().local, "stack", None)
+    return stack[-1] if stack else "other"
+
+@contextlib.contextmanager
+def span(stage:str):
+    """단계 시간 측정 → 전역 히스토그램 + 현재 리런 내역. 풀 스레드에서도 제출한 리런에 합산."""
+    stack = tracer().local.__dict__.setdefault("stack", [])
+    run, t0 = current_run(), time.perf_counter()
+    top = not stack and run is not None and run["thread"] == threading.get_ident()
+    stack.append(stage)
+    try:
+        yield
+    finally:
+        stack.pop()
+        sec = time.perf_counter() - t0
+        tracer().observe(stage, sec)
+        if run is not None:
+            run["stages"][stage] = run["stages"].get(stage, 0.0) + sec
+            if top: run["covered"] += sec   # 스크립트 스레드의 최상위 스팬만(중첩·병렬 중복 제외)
+
+def traced(stage:str):
+    """함수(제너레이터면 소진까지)를 span으로 감쌈."""
+    def deco(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def gen(*args, **kwargs):
+                with span(stage): yield from fn(*args, **kwargs)
+            return gen
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage): return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def begin_rerun(kind:str="app"):
+    ss = st.session_state
+    ss.trace_seq = ss.get("trace_seq", 0) + 1
+    ss.trace_run = {"run": ss.trace_seq, "kind": kind, "ts": time.time(), "t0": time.perf_counter(),
+                    "thread": threading.get_ident(), "covered": 0.0, "stages": {}}
+
+def end_rerun(how:str="end"):
+    """리런 1회 마감: 총 시간 기록, 최근 N회 보관, 필요 시 JSONL 내보내기."""
+    run = current_run()
+    if not run or "total" in run: return
+    run["total"], run["end"] = time.perf_counter() - run["t0"], how
+    ss = st.session_state
+    if "trace_runs" not in ss: ss.trace_runs = deque(maxlen=TRACE_RERUNS)
+    ss.trace_runs.append(run)
+    if TRACE_FILE:
+        rec = {"ts": run["ts"], "sid": ss.get("sid"), "run": run["run"], "kind": run["kind"], "end": how,
+               "total": round(run["total"], 6), "stages": {k: round(v, 6) for k,v in run["stages"].items()}}
+        with open(TRACE_FILE, "a", encoding="utf-8") as f: f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+def fragment_rerun()->bool:
+    """지금이 프래그먼트 단독 리런인지(전체 스크립트 실행 중이면 False)."""
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+def rerun(scope:str="app"):
+    """st.rerun 전에 이번 리런 계측을 마감(예외로 끝나 기록이 빠지지 않게).
+    scope="fragment"는 프래그먼트 단독 리런 중에만 유효 → 전체 실행 중이면 앱 전체로."""
+    if scope == "fragment" and not fragment_rerun(): scope = "app"
+    end_rerun("rerun"); st.rerun(scope=scope)
+
+begin_rerun()
+
+# ------------------ 이미지(업로드 → 축소 → WebP data URI) ------------------
+IMG_DPR   = 2     # 고해상도 화면 대비 배율
+HERO_H    = 300   # .hero 높이
+AVATAR_PX = 88    # .avaWrap 지름
+
+def upload_bytes(file)->bytes:
+    if not file: return b""
     try:
-        data = file.getvalue()
+        return file.getvalue()
     except Exception:
         data = file.read()
         try: file.seek(0)
         except Exception: pass
-    return base64.b64encode(data).decode()
+        return data
 
-hero_b64 = upload_to_b64(hero_up)
-avatar_b64 = upload_to_b64(avatar_up)
+def _encode(img)->tuple:
+    buf = io.BytesIO()
+    try:
+        img.save(buf, format="WEBP", quality=80, method=4); mime = "image/webp"
+    except Exception:   # WebP 미지원 빌드
+        buf = io.BytesIO(); img.save(buf, format="PNG", optimize=True); mime = "image/png"
+    return mime, base64.b64encode(buf.getvalue()).decode()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _fit_image(digest:str, w:int, h:int, _data:bytes)->str:
+    # 키는 내용 해시+크기만(수 MB 원본을 캐시 키로 다시 해싱하지 않음). 세션 간 공유
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(_data)))
+    img = ImageOps.fit(img.convert("RGBA" if "A" in img.getbands() else "RGB"), (w, h), Image.LANCZOS)   # object-fit:cover와 동일한 크롭
+    mime, b64 = _encode(img)
+    return f"data:{mime};base64,{b64}"
+
+@traced("image")
+def image_src(file, w:int, h:int)->str:
+    """업로드 파일을 화면 크기(w×h, DPR 반영)로 줄인 data URI. 없거나 깨진 파일이면 빈 문자열."""
+    data = upload_bytes(file)
+    if not data: return ""
+    try:
+        return _fit_image(hashlib.sha1(data).hexdigest(), w*IMG_DPR, h*IMG_DPR, data)
+    except Exception:
+        return ""
+
+@st.cache_data(show_spinner=False)
+def default_avatar_src()->str:
+    av = Image.new("RGB",(200,200),(21,27,46)); d=ImageDraw.Draw(av)
+    d.ellipse((4,4,196,196), fill=(33,41,72))
+    d.text((80,86), "AVA", fill=(220,230,255))
+    mime, b64 = _encode(av.resize((AVATAR_PX*IMG_DPR,)*2, Image.LANCZOS))
+    return f"data:{mime};base64,{b64}"
+
+hero_src = image_src(hero_up, PHONE_W, HERO_H)
+avatar_src = image_src(avatar_up, AVATAR_PX, AVATAR_PX)
 
 # ------------------ LLM ------------------
-# ------------------ LLM ------------------
-USE_LLM, MODEL = False, None
-if API_KEY:
-    try:
+# 우선순위: 2.5 Flash → 2.5 Flash-Lite → 2.0 Flash → 2.5 Flash Preview
+GEMINI_MODELS = (
+    "gemini-2.5-flash",                 # 일반 추천
+    "gemini-2.5-flash-lite",            # 더 저렴/고효율
+    "gemini-2.0-flash",                 # 구세대 2.0 대안
+    "gemini-2.5-flash-preview-09-2025"  # 가용 시 프리뷰
+)
+MODEL_REPROBE_AFTER = 3   # 연속 실패 N회면 폴백 목록 재탐색
+
+class GeminiClient:
+    """API 키당 1개. 모델 선택/가용성 확인은 한 번만 하고 리런·세션 간 재사용."""
+    def __init__(self, api_key:str):
         import google.generativeai as genai
-        genai.configure(api_key=API_KEY)
-
-        # 우선순위: 2.5 Flash → 2.5 Flash-Lite → 2.0 Flash → 2.5 Flash Preview
-        for _model in (
-            "gemini-2.5-flash",                 # 일반 추천
-            "gemini-2.5-flash-lite",            # 더 저렴/고효율
-            "gemini-2.0-flash",                 # 구세대 2.0 대안
-            "gemini-2.5-flash-preview-09-2025"  # 가용 시 프리뷰
-        ):
+        genai.configure(api_key=api_key)
+        self._genai, self._lock = genai, threading.Lock()
+        self.model, self.name, self.fails = None, None, 0
+        self.resolve()
+
+    def resolve(self, avoid=None):
+        """목록 순서대로 실제 가용(generateContent 지원) 모델을 찾음. avoid는 맨 뒤로."""
+        order = [m for m in GEMINI_MODELS if m != avoid] + ([avoid] if avoid else [])
+        errors = []
+        for name in order:
+            try:
+                info = self._genai.get_model(f"models/{name}")
+                if "generateContent" not in (getattr(info, "supported_generation_methods", None) or []):
+                    raise RuntimeError("generateContent 미지원")
+                self.model, self.name, self.fails = self._genai.GenerativeModel(name), name, 0
+                return name
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+        raise RuntimeError("사용 가능한 Gemini 모델을 찾지 못했습니다. 모델/리전을 확인하세요. " + " / ".join(errors))
+
+    def generate_content(self, *args, **kwargs):
+        try:
+            res = self.model.generate_content(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.fails += 1
+                if self.fails >= MODEL_REPROBE_AFTER:
+                    try: self.resolve(avoid=self.name)
+                    except Exception: self.fails = 0   # 재탐색도 실패 → 기존 모델 유지, N회 뒤 재시도
+            raise
+        self.fails = 0
+        return res
+
+CLIENT_RETRY_MIN, CLIENT_RETRY_MAX = 30, 600   # 초기화 실패 후 재시도 대기(초, 실패마다 2배)
+
+@st.cache_resource(show_spinner=False)
+def _gemini_client(api_key:str):
+    return GeminiClient(api_key)
+
+@st.cache_resource(show_spinner=False)
+def client_failures():
+    return {}   # 키 지문 → (다음 시도 시각, 대기, 오류 문구)
+
+def gemini_client(api_key:str):
+    """성공한 클라이언트는 캐시. 실패는 키별로 기억해 대기 시간 동안 네트워크 재탐색 없이 바로 같은 오류."""
+    key, now = hashlib.sha256(api_key.encode()).hexdigest()[:16], time.monotonic()
+    fail = client_failures().get(key)
+    if fail and now < fail[0]:
+        raise RuntimeError(f"{fail[2]} (재시도까지 {fail[0] - now:.0f}초)")
+    try:
+        client = _gemini_client(api_key)
+    except Exception as e:
+        wait = min(CLIENT_RETRY_MAX, fail[1] * 2) if fail else CLIENT_RETRY_MIN
+        client_failures()[key] = (now + wait, wait, str(e))
+        raise
+    client_failures().pop(key, None)
+    return client
+
+class FakeModel:
+    """테스트/벤치용 로컬 모델. COACH_FAKE_LLM="latency=0.3,fail=0.1,seed=1" 형식."""
+    name = "fake"
+    def __init__(self, latency=0.05, fail=0.0, seed=None):
+        self.latency, self.fail, self._rng = latency, fail, random.Random(seed)
+
+    @classmethod
+    def from_spec(cls, spec:str):
+        kv = dict(p.split("=", 1) for p in spec.split(",") if "=" in p)
+        return cls(float(kv.get("latency", 0.05)), float(kv.get("fail", 0.0)),
+                   int(kv["seed"]) if "seed" in kv else None)
+
+    def _answer(self, prompt, generation_config):
+        if (generation_config or {}).get("response_mime_type") == "application/json":
+            return json.dumps({"tab": "home", "reply": "테스트 답변입니다.", "explain": "테스트 설명입니다.",
+                               "handoff_summary": "테스트 요약", "merchant": None, "amount": None,
+                               "actions": [], "arguments": {}}, ensure_ascii=False)
+        if "@reply" in prompt:   # 스트리밍 융합 호출 형식
+            return "@tab home\n@reply\n테스트 답변입니다.\n" + "".join(
+                f"@{k}\n테스트 {k}\n" for k in ("explain", "handoff_summary") if f"@{k}" in prompt)
+        return f"테스트 답변입니다. ({len(prompt)}자 프롬프트)"
+
+    def generate_content(self, prompt, stream=False, generation_config=None, request_options=None, **_):
+        timeout = (request_options or {}).get("timeout")
+        time.sleep(min(self.latency, timeout) if timeout else self.latency)
+        if timeout and self.latency > timeout: raise TimeoutError("fake deadline exceeded")
+        if self._rng.random() < self.fail: raise ConnectionError("fake backend failure")
+        text = self._answer(prompt, generation_config)
+        if not stream: return types.SimpleNamespace(text=text)
+        return iter([types.SimpleNamespace(text=text[i:i+8]) for i in range(0, len(text), 8)])
+
+# ------------------ LLM 게이트웨이(속도 제한·재시도·차단기) ------------------
+LLM_RPS = float(os.getenv("COACH_LLM_RPS", "2"))       # 프로세스 전체 초당 호출
+LLM_BURST = int(os.getenv("COACH_LLM_BURST", "5"))
+LLM_MAX_INFLIGHT = 4     # 동시 호출 상한
+LLM_DEADLINE = 20        # 호출 1건의 전체 마감(재시도·대기 포함, 초)
+LLM_RETRIES = 2          # 일시 오류 재시도 횟수
+BREAKER_FAILS, BREAKER_COOLDOWN = 5, 30   # 연속 실패 N회 → 쿨다운 동안 규칙 기반으로
+RETRYABLE = {"ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError",
+             "TooManyRequests", "TimeoutError", "ConnectionError"}
+
+class LLMUnavailable(RuntimeError):
+    """차단기 열림/속도 제한 대기 초과. 호출부는 규칙 기반 경로로 폴백."""
+
+class TokenBucket:
+    def __init__(self, rate:float, burst:int):
+        self.rate, self.burst, self.tokens = rate, burst, float(burst)
+        self._t, self._lock = time.monotonic(), threading.Lock()
+
+    def acquire(self, deadline:float)->bool:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._t) * self.rate)
+                self._t = now
+                if self.tokens >= 1:
+                    self.tokens -= 1; return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline: return False
+            time.sleep(wait)
+
+class CircuitBreaker:
+    """closed → (연속 실패) open → (쿨다운 후 시험 호출 1건) half-open → 성공 시 closed.
+    시험 호출이 결과 없이 사라져도(스트림 중단 등) 쿨다운이 한 번 더 지나면 다음 시험 호출 허용."""
+    def __init__(self, fails:int, cooldown:float):
+        self.max_fails, self.cooldown = fails, cooldown
+        self.state, self.fails, self.opened = "closed", 0, 0.0
+        self._lock = threading.Lock()
+
+    def _due(self)->bool:
+        # open: 쿨다운 경과 / half-open: 시험 호출 시작(opened 갱신) 후 쿨다운 경과 = 시험 호출 유실
+        return self.state != "closed" and time.monotonic() - self.opened >= self.cooldown
+
+    def available(self)->bool:
+        return self.state == "closed" or self._due()
+
+    def allow(self)->bool:
+        with self._lock:
+            if self.state == "closed": return True
+            if self._due():
+                self.state, self.opened = "half-open", time.monotonic(); return True   # 시험 호출은 1건만
+            return False
+
+    def release(self):
+        """시험 호출을 모델에 보내지 못함(대기 초과) → 판단 보류, 바로 다음 시험 호출 허용."""
+        with self._lock:
+            if self.state == "half-open": self.state, self.opened = "open", 0.0
+
+    def success(self):
+        with self._lock: self.state, self.fails = "closed", 0
+
+    def failure(self):
+        with self._lock:
+            self.fails += 1
+            if self.state == "half-open" or self.fails >= self.max_fails:
+                self.state, self.opened = "open", time.monotonic()
+
+class LLMGateway:
+    """모든 LLM 호출의 단일 창구. 토큰 버킷 → 동시성 슬롯 → 마감 내 지터 재시도, 결과는 차단기에 기록."""
+    def __init__(self, client):
+        self.client = client
+        self.bucket = TokenBucket(LLM_RPS, LLM_BURST)
+        self.breaker = CircuitBreaker(BREAKER_FAILS, BREAKER_COOLDOWN)
+        self._slots = threading.BoundedSemaphore(LLM_MAX_INFLIGHT)
+        self.calls = self.retries = self.rejected = 0
+
+    @property
+    def name(self)->str:
+        return self.client.name   # 재탐색으로 모델이 바뀌어도 현재 이름
+
+    def available(self)->bool:
+        return self.breaker.available()
+
+    def _enter(self, deadline):
+        if not self.breaker.allow():
+            self.rejected += 1; raise LLMUnavailable("LLM 일시 차단(연속 실패)")
+        if not self.bucket.acquire(deadline) or not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self.breaker.release()
+            self.rejected += 1; raise LLMUnavailable("LLM 호출 대기 초과")
+        self.calls += 1
+
+    def _attempts(self, args, kwargs, deadline):
+        for attempt in range(LLM_RETRIES + 1):
+            left = deadline - time.monotonic()
             try:
-                MODEL = genai.GenerativeModel(_model)
-                USE_LLM = True
-                break
-            except Exception:
-                continue
+                return self.client.generate_content(*args, request_options={"timeout": left}, **kwargs)
+            except Exception as e:
+                backoff = random.uniform(0, 0.5 * 2**attempt)   # full jitter
+                if (type(e).__name__ not in RETRYABLE or attempt == LLM_RETRIES
+                        or time.monotonic() + backoff >= deadline):
+                    raise
+                self.retries += 1
+                time.sleep(backoff)
+
+    def generate_content(self, *args, stream=False, timeout=LLM_DEADLINE, **kwargs):
+        deadline = time.monotonic() + timeout
+        if stream: return self._stream(args, kwargs, deadline)
+        self._enter(deadline)
+        try:
+            res = self._attempts(args, kwargs, deadline)
+        except BaseException:
+            self.breaker.failure(); raise
+        finally:
+            self._slots.release()
+        self.breaker.success()
+        self._count(args, res, getattr(res, "text", "") or "")
+        return res
+
+    @staticmethod
+    def _count(args, res, text:str):
+        # 응답 메타데이터의 실제 토큰 수 우선, 없으면(스트림/가짜 모델) 추정치
+        um = getattr(res, "usage_metadata", None)
+        prompt = str(args[0]) if args else ""
+        p = getattr(um, "prompt_token_count", 0) or est_tokens(prompt)
+        o = getattr(um, "candidates_token_count", 0) or est_tokens(text)
+        tracer().count_tokens(current_stage(), p, o)
+
+    def _stream(self, args, kwargs, deadline):
+        # 첫 조각 전 오류만 재시도(이미 보낸 조각은 되돌릴 수 없음). 슬롯은 스트림 끝까지 점유
+        self._enter(deadline)
+        parts, chunk = [], None
+        try:
+            for chunk in self._attempts(args, dict(kwargs, stream=True), deadline):
+                parts.append(getattr(chunk, "text", "") or "")
+                yield chunk
+            self._count(args, chunk, "".join(parts))
+        except GeneratorExit:
+            # 호출자가 중간에 버린 스트림(리런 등): 조각을 받았으면 모델은 정상
+            (self.breaker.success if parts else self.breaker.failure)(); raise
+        except BaseException:
+            self.breaker.failure(); raise
+        else:
+            self.breaker.success()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {"state": self.breaker.state, "calls": self.calls, "retries": self.retries, "rejected": self.rejected}
+
+FAKE_LLM = os.getenv("COACH_FAKE_LLM")
 
-        if not USE_LLM:
-            raise RuntimeError("사용 가능한 Gemini 모델을 찾지 못했습니다. 모델/리전을 확인하세요.")
+@st.cache_resource(show_spinner=False)
+def llm_gateway(api_key:str|None, fake:str|None):
+    # 프로세스 공용: 속도 제한·차단기 상태를 모든 세션이 공유
+    return LLMGateway(FakeModel.from_spec(fake) if fake else gemini_client(api_key))
 
+USE_LLM, MODEL = False, None
+if API_KEY or FAKE_LLM:
+    try:
+        MODEL = llm_gateway(API_KEY, FAKE_LLM)
+        USE_LLM = True
+        st.sidebar.caption(f"모델: {MODEL.name}")
     except Exception as e:
         st.sidebar.error(f"Gemini 초기화 실패: {e}")
 
+def llm_on()->bool:
+    """LLM 경로 사용 여부. 차단기가 열린 동안은 False → 각 헬퍼가 규칙 기반으로 동작."""
+    return USE_LLM and MODEL.available()
+
 # ------------------ 고객/계정 '지식' (샘플) ------------------
 def age_from_dob(dob):
     y,m,d = map(int, dob.split("-"))
     today = datetime.date.today()
     return today.year - y - ((today.month, today.day) < (m, d))
 
-CUSTOMER = {
-    "profile": {
-        "name": "김하나", "cust_id": "C-202409-10293", "tier": "Gold",
-        "dob": "1992-05-20", "age": None,
-        "phone": "010-12**-56**", "email": "hana***@gmail.com",
-        "city": "서울", "district": "마포구",
-        "consent": {"marketing": True, "personalization": True}
-    },
-    "accounts": [
-        {"type":"입출금","name":"하나페이 통장","balance":1_235_000,"last_tx":"2025-09-01","low_alert":800_000},
-        {"type":"신용카드","name":"Alpha Card","limit":5_000_000,"used":1_270_000,"statement_due":"2025-09-10","min_due":320_000},
-        {"type":"적금","name":"목표적금(여행)","monthly":250_000,"balance":1_000_000,"maturity":"2026-03-01"},
-    ],
-    "owned_cards": [
-        {"name":"Alpha Card","mcc":["FNB","CAFE","GROC"],"rate":0.05,"cap":20000,"month_accum":5000,"color":"#5B8DEF"},
-        {"name":"Beta Card","mcc":["ALL"],"rate":0.02,"cap":50000,"month_accum":12000,"color":"#34C38F"},
-        {"name":"Cinema Max","mcc":["CINE"],"rate":0.10,"cap":15000,"month_accum":9000,"color":"#F1B44C"},
-    ],
-    "budgets": {
-        "Dining": {"limit":300_000,"spent":220_000},
-        "Groceries": {"limit":250_000,"spent":180_000},
-        "Transport": {"limit":100_000,"spent":68_000},
-    },
-    "schedule": [
-        {"date":"2025-09-05","title":"Alpha Card 납부","amount":320_000},
-        {"date":"2025-09-15","title":"적금 자동이체","amount":250_000},
-        {"date":"2025-09-28","title":"여행 적립 체크","amount":0},
-    ],
-    "goal": {"name":"여행 자금","target":2_000_000,"months":8,"monthly":250_000,"progress":19},
-    "merchants": {"스타커피":"CAFE","버거팰리스":"FNB","김밥왕":"FNB","메가시네마":"CINE","편의점 CU":"GROC"},
-}
-CUSTOMER["profile"]["age"] = age_from_dob(CUSTOMER["profile"]["dob"])
-
-TX_LOG = pd.DataFrame([
-    {"date":"2025-08-27","merchant":"편의점 CU","mcc":"GROC","amount":6200},
-    {"date":"2025-08-28","merchant":"스타커피 본점","mcc":"CAFE","amount":4800},
-    {"date":"2025-08-29","merchant":"김밥왕","mcc":"FNB","amount":8200},
-    {"date":"2025-08-30","merchant":"메가시네마","mcc":"CINE","amount":12000},
-])
+@st.cache_resource(show_spinner=False)
+def seed_data():
+    """샘플 고객/거래(프로세스 공유·읽기 전용). 저장소가 처음 만들 때 복사해 쓰므로 직접 수정 금지."""
+    customer = {
+        "profile": {
+            "name": "김하나", "cust_id": "C-202409-10293", "tier": "Gold",
+            "dob": "1992-05-20", "age": None,
+            "phone": "010-12**-56**", "email": "hana***@gmail.com",
+            "city": "서울", "district": "마포구",
+            "consent": {"marketing": True, "personalization": True}
+        },
+        "accounts": [
+            {"type":"입출금","name":"하나페이 통장","balance":1_235_000,"last_tx":"2025-09-01","low_alert":800_000},
+            {"type":"신용카드","name":"Alpha Card","limit":5_000_000,"used":1_270_000,"statement_due":"2025-09-10","min_due":320_000},
+            {"type":"적금","name":"목표적금(여행)","monthly":250_000,"balance":1_000_000,"maturity":"2026-03-01"},
+        ],
+        "owned_cards": [
+            {"name":"Alpha Card","mcc":["FNB","CAFE","GROC"],"rate":0.05,"cap":20000,"month_accum":5000,"color":"#5B8DEF"},
+            {"name":"Beta Card","mcc":["ALL"],"rate":0.02,"cap":50000,"month_accum":12000,"color":"#34C38F"},
+            {"name":"Cinema Max","mcc":["CINE"],"rate":0.10,"cap":15000,"month_accum":9000,"color":"#F1B44C"},
+        ],
+        "budgets": {
+            "Dining": {"limit":300_000,"spent":220_000},
+            "Groceries": {"limit":250_000,"spent":180_000},
+            "Transport": {"limit":100_000,"spent":68_000},
+        },
+        "schedule": [
+            {"date":"2025-09-05","title":"Alpha Card 납부","amount":320_000},
+            {"date":"2025-09-15","title":"적금 자동이체","amount":250_000},
+            {"date":"2025-09-28","title":"여행 적립 체크","amount":0},
+        ],
+        "goal": {"name":"여행 자금","target":2_000_000,"months":8,"monthly":250_000,"progress":19},
+        "merchants": {"스타커피":"CAFE","버거팰리스":"FNB","김밥왕":"FNB","메가시네마":"CINE","편의점 CU":"GROC"},
+    }
+    customer["profile"]["age"] = age_from_dob(customer["profile"]["dob"])
+
+    tx = [
+        {"date":"2025-08-27","merchant":"편의점 CU","mcc":"GROC","amount":6200},
+        {"date":"2025-08-28","merchant":"스타커피 본점","mcc":"CAFE","amount":4800},
+        {"date":"2025-08-29","merchant":"김밥왕","mcc":"FNB","amount":8200},
+        {"date":"2025-08-30","merchant":"메가시네마","mcc":"CINE","amount":12000},
+    ]
+    return customer, tx
+
+SEED_CUSTOMER, SEED_TX = seed_data()
+
+# ------------------ 거래 저장소 ------------------
+DATA_DIR = os.getenv("COACH_DATA_DIR", ".coach_data")
+TX_VIEW_ROWS = 200   # 화면 표 최대 행수(이력이 커져도 렌더 비용 고정)
+
+class TxStore:
+    """고객별 거래 로그(SQLite, WAL). 최근 N건·MCC 합계·기간 조회는 인덱스로 처리."""
+    COLS = ("date","merchant","mcc","amount")
+
+    def __init__(self, path:str):
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock, self._seeded = threading.Lock(), set()
+        with self._lock:
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("PRAGMA synchronous=NORMAL")
+            self._con.executescript("""
+                CREATE TABLE IF NOT EXISTS tx(
+                    id INTEGER PRIMARY KEY, cust_id TEXT NOT NULL, date TEXT NOT NULL,
+                    merchant TEXT, mcc TEXT, amount INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS tx_cust_id   ON tx(cust_id, id);
+                CREATE INDEX IF NOT EXISTS tx_cust_date ON tx(cust_id, date);
+                CREATE INDEX IF NOT EXISTS tx_cust_mcc  ON tx(cust_id, mcc, date);
+            """)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._con.execute(sql, args).fetchall()
+
+    def append_many(self, cust_id:str, rows):
+        vals = [(cust_id, r["date"], r["merchant"], r["mcc"], int(r["amount"])) for r in rows]
+        with self._lock:
+            self._con.execute("BEGIN")
+            self._con.executemany("INSERT INTO tx(cust_id,date,merchant,mcc,amount) VALUES(?,?,?,?,?)", vals)
+            self._con.execute("COMMIT")
+
+    def count(self, cust_id:str)->int:
+        return self._query("SELECT COUNT(*) FROM tx WHERE cust_id=?", (cust_id,))[0][0]
+
+    def latest(self, cust_id:str, n:int=20):
+        rows = self._query("SELECT date,merchant,mcc,amount FROM tx WHERE cust_id=? ORDER BY id DESC LIMIT ?", (cust_id, n))
+        return pd.DataFrame(rows[::-1], columns=self.COLS)
+
+    def between(self, cust_id:str, start:str, end:str):
+        rows = self._query("SELECT date,merchant,mcc,amount FROM tx WHERE cust_id=? AND date BETWEEN ? AND ? ORDER BY date, id",
+                           (cust_id, start, end))
+        return pd.DataFrame(rows, columns=self.COLS)
+
+    def mcc_sums(self, cust_id:str, start:str="0000-00-00", end:str="9999-99-99")->dict:
+        rows = self._query("SELECT mcc, SUM(amount) FROM tx WHERE cust_id=? AND date BETWEEN ? AND ? GROUP BY mcc",
+                           (cust_id, start, end))
+        return dict(rows)
+
+    def since(self, cust_id:str, after_id:int):
+        """id > after_id 인 거래를 (id, date, merchant, mcc, amount) 순서대로(증분 집계용)."""
+        return self._query("SELECT id,date,merchant,mcc,amount FROM tx WHERE cust_id=? AND id>? ORDER BY id", (cust_id, after_id))
+
+    def monthly_totals(self, cust_id:str)->dict:
+        """월(YYYY-MM)별 지출 합계."""
+        return dict(self._query("SELECT substr(date,1,7), SUM(amount) FROM tx WHERE cust_id=? GROUP BY 1", (cust_id,)))
+
+    def for_customer(self, cust_id:str, seed=()):
+        if seed and cust_id not in self._seeded:   # 시드 확인은 고객당 한 번(리런마다 COUNT 쿼리 안 함)
+            if self.count(cust_id) == 0: self.append_many(cust_id, seed)
+            self._seeded.add(cust_id)
+        return CustomerTx(self, cust_id)
+
+class CustomerTx:
+    """한 고객의 거래 뷰. tail(n)은 DataFrame이라 기존 호출부와 호환."""
+    def __init__(self, store:TxStore, cust_id:str):
+        self.store, self.cust_id = store, cust_id
+    def __len__(self): return self.store.count(self.cust_id)
+    def tail(self, n:int=20): return self.store.latest(self.cust_id, n)
+    def append(self, row:dict): self.store.append_many(self.cust_id, [row])
+    def between(self, start, end): return self.store.between(self.cust_id, start, end)
+    def mcc_sums(self, start="0000-00-00", end="9999-99-99"): return self.store.mcc_sums(self.cust_id, start, end)
+    def monthly_totals(self): return self.store.monthly_totals(self.cust_id)
+    def since(self, after_id:int): return self.store.since(self.cust_id, after_id)
+
+class ChatStore:
+    """메모리 한도를 넘긴 오래된 대화를 세션별로 보관(같은 DB 파일, 별도 연결)."""
+    def __init__(self, path:str):
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("""CREATE TABLE IF NOT EXISTS chat(
+                sid TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT, text TEXT, PRIMARY KEY(sid, seq))""")
+
+    def spill(self, sid:str, start_seq:int, msgs):
+        vals = [(sid, start_seq+i, r, t) for i,(r,t) in enumerate(msgs)]
+        with self._lock:
+            self._con.execute("BEGIN")
+            self._con.executemany("INSERT OR REPLACE INTO chat VALUES(?,?,?,?)", vals)
+            self._con.execute("COMMIT")
+
+    def page(self, sid:str, before_seq:int, n:int):
+        """seq < before_seq 중 최근 n개를 (seq, role, text) 오름차순으로."""
+        with self._lock:
+            rows = self._con.execute("SELECT seq, role, text FROM chat WHERE sid=? AND seq<? ORDER BY seq DESC LIMIT ?",
+                                     (sid, before_seq, n)).fetchall()
+        return rows[::-1]
+
+@st.cache_resource(show_spinner=False)
+def chat_store():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return ChatStore(os.path.join(DATA_DIR, "coach.db"))
+
+@st.cache_resource(show_spinner=False)
+def tx_store():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return TxStore(os.path.join(DATA_DIR, "coach.db"))
+
+# ------------------ 고객 상태 저장소 ------------------
+class Snapshot:
+    """불변으로 취급하는 고객 상태 한 버전. data는 여러 세션이 공유하므로 직접 수정 금지(→ mutate)."""
+    __slots__ = ("cust_id", "version", "data")
+    def __init__(self, cust_id, version, data):
+        self.cust_id, self.version, self.data = cust_id, version, data
+
+class StateStore:
+    """고객별 최신 스냅샷(메모리) + SQLite 영속. 읽기는 복사 없이 공유(DB 버전만 확인), 쓰기는 복사본에 적용 후 새 버전 발행.
+    파생값(이용률·예산·건강 점수 등)은 (고객, 버전)당 한 번만 계산."""
+    def __init__(self, path:str):
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("""CREATE TABLE IF NOT EXISTS customer_state(
+            cust_id TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL, updated REAL)""")
+        self._lock = threading.RLock()
+        self._snaps, self._derived = {}, {}
+
+    def _load(self, cust_id):
+        row = self._con.execute("SELECT version, data FROM customer_state WHERE cust_id=?", (cust_id,)).fetchone()
+        return Snapshot(cust_id, row[0], json.loads(row[1])) if row else None
+
+    def _save(self, snap):
+        self._con.execute("INSERT OR REPLACE INTO customer_state VALUES(?,?,?,?)",
+                          (snap.cust_id, snap.version, json.dumps(snap.data, ensure_ascii=False), time.time()))
+
+    def _db_version(self, cust_id):
+        row = self._con.execute("SELECT version FROM customer_state WHERE cust_id=?", (cust_id,)).fetchone()
+        return row[0] if row else 0
+
+    def _publish(self, snap):
+        self._snaps[snap.cust_id] = snap
+        self._derived = {k:v for k,v in self._derived.items() if not (k[0]==snap.cust_id and k[1] < snap.version)}
+
+    def snapshot(self, cust_id:str, seed=None)->Snapshot:
+        """최신 스냅샷. 메모리 사본이 있어도 DB 버전(기본키 조회 1회)을 확인해 다른 프로세스가 더 새로 썼으면 다시 읽음."""
+        with self._lock:
+            snap = self._snaps.get(cust_id)
+            if snap is None or self._db_version(cust_id) > snap.version:
+                snap = self._load(cust_id)
+                if snap is None:
+                    snap = Snapshot(cust_id, 1, copy.deepcopy(seed)); self._save(snap)
+                self._publish(snap)
+            return snap
+
+    def update(self, cust_id:str, fn)->Snapshot:
+        """fn(draft)로 복사본을 고쳐 새 버전 발행. 다른 프로세스가 먼저 썼으면 그 버전 위에 적용."""
+        with self._lock:
+            cur = self.snapshot(cust_id)
+            draft = copy.deepcopy(cur.data); fn(draft)
+            snap = Snapshot(cust_id, cur.version + 1, draft)
+            self._save(snap); self._publish(snap)
+            return snap
+
+    def derived(self, snap:Snapshot, name:str, fn):
+        key = (snap.cust_id, snap.version, name)
+        if key not in self._derived: self._derived[key] = fn()
+        return self._derived[key]
+
+@st.cache_resource(show_spinner=False)
+def state_store():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return StateStore(os.path.join(DATA_DIR, "coach.db"))
+
+CUST_ID = SEED_CUSTOMER["profile"]["cust_id"]
+SNAP = state_store().snapshot(CUST_ID, seed=SEED_CUSTOMER)
+CUSTOMER = SNAP.data
+
+def mutate(fn)->Snapshot:
+    """CUSTOMER 변경은 반드시 여기로: 새 스냅샷을 발행하고 이번 실행의 CUSTOMER도 교체."""
+    global SNAP, CUSTOMER
+    SNAP = state_store().update(CUST_ID, fn); CUSTOMER = SNAP.data
+    return SNAP
+
+def per_version(fn):
+    """현재 스냅샷 버전당 한 번만 계산하는 파생값."""
+    @functools.wraps(fn)
+    def wrap():
+        return state_store().derived(SNAP, fn.__name__, fn)
+    return wrap
+
+if CUSTOMER["profile"].get("age") != age_from_dob(CUSTOMER["profile"]["dob"]):   # 생일 지나면 갱신
+    mutate(lambda c: c["profile"].update(age=age_from_dob(c["profile"]["dob"])))
+
+TX_LOG = tx_store().for_customer(CUST_ID, seed=SEED_TX)
+
+# ------------------ 감사 로그 ------------------
+AUDIT_MAX_BYTES = 5 * 1024 * 1024   # 파일당 크기 → 넘으면 회전
+AUDIT_KEEP      = 10                # 회전 파일 보관 개수(audit.1.jsonl ~ audit.N.jsonl)
+AUDIT_BATCH     = 256               # 한 번에 쓰는 최대 이벤트 수
+AUDIT_FLUSH_SEC = 1.0               # 배치를 모으는 최대 대기
+AUDIT_RETRY_SEC = 5.0               # 쓰기 실패 후 새 이벤트가 없어도 이 간격으로 재시도
+AUDIT_BACKLOG   = AUDIT_BATCH * 8   # 디스크 장애 동안 메모리에 보관하는 최대 이벤트 수(초과분은 오래된 것부터 버리고 기록)
+AUDIT_TAIL      = 50                # 세션 화면용 최근 N건
+
+_log = logging.getLogger("coach.audit")
+
+class AuditSink:
+    """감사 이벤트를 큐로 받아 백그라운드 스레드가 배치 단위로 JSONL에 append + fsync(배치당 1회).
+    UI 스레드는 emit(큐 적재)만 하므로 I/O를 기다리지 않음. 쓰기 실패한 배치는 AUDIT_RETRY_SEC마다 재시도하고,
+    보관 한도를 넘어 버린 건수는 dropped에 누적 + 경고 로그(사이드바에도 표시), 복구 후 audit_gap 이벤트로 남김."""
+    def __init__(self, dirpath:str, max_bytes=AUDIT_MAX_BYTES, keep=AUDIT_KEEP):
+        os.makedirs(dirpath, exist_ok=True)
+        self.dir, self.max_bytes, self.keep = dirpath, max_bytes, keep
+        self.path = os.path.join(dirpath, "audit.jsonl")
+        self._q, self._retry = queue.Queue(), []
+        self.dropped, self.last_error, self._gap = 0, None, 0
+        self._thread = threading.Thread(target=self._run, name="audit-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, event:dict):
+        self._q.put(event)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._q.get(timeout=AUDIT_RETRY_SEC if self._retry else None)]
+            except queue.Empty:
+                self._flush(self._retry); continue   # 새 이벤트 없이도 실패분 재시도
+            deadline = time.monotonic() + AUDIT_FLUSH_SEC
+            while len(batch) < AUDIT_BATCH:
+                try: batch.append(self._q.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty: break
+            stop = None in batch
+            self._flush(self._retry + [e for e in batch if e is not None])
+            if stop: return
+
+    def _flush(self, events):
+        if not events: return
+        gap = [{"ts": time.time(), "type": "audit_gap", "dropped": self._gap}] if self._gap else []   # 폐기 사실도 로그에
+        data = "".join(json.dumps(e, ensure_ascii=False, default=str) + "\n" for e in gap + events).encode()
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data); f.flush(); os.fsync(f.fileno())
+            self._retry, self.last_error, self._gap = [], None, 0
+        except OSError as e:
+            over = len(events) - AUDIT_BACKLOG
+            if over > 0:
+                self.dropped += over; self._gap += over
+                _log.error("감사 로그 쓰기 실패 지속: 오래된 이벤트 %d건 폐기(누적 %d건): %s", over, self.dropped, e)
+            elif self.last_error is None:
+                _log.warning("감사 로그 쓰기 실패, %d건 보관 후 %.0f초마다 재시도: %s", len(events), AUDIT_RETRY_SEC, e)
+            self._retry, self.last_error = events[-AUDIT_BACKLOG:], str(e)
+
+    def stats(self):
+        return {"pending": len(self._retry), "dropped": self.dropped, "error": self.last_error}
+
+    def _rotate(self):
+        name = lambda i: os.path.join(self.dir, f"audit.{i}.jsonl")
+        if os.path.exists(name(self.keep)): os.remove(name(self.keep))
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.exists(name(i)): os.replace(name(i), name(i + 1))
+        os.replace(self.path, name(1))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._q.put(None); self._thread.join(timeout=5)
+
+@st.cache_resource(show_spinner=False)
+def audit_sink():
+    return AuditSink(os.path.join(DATA_DIR, "audit"))
+
+def audit(event:dict):
+    """감사 이벤트: 영속 로그로 비동기 전송 + 세션 꼬리(최근 AUDIT_TAIL건)에 보관."""
+    event = {"ts": time.time(), "sid": ss.sid, "cust_id": CUST_ID, **event}
+    audit_sink().emit(event)
+    ss.audit.append(event)
+
+def crm_handoff(item:dict):
+    """상담사 핸드오프: 감사 로그에 남기고 화면용 큐에는 최근 건만."""
+    audit_sink().emit({"ts": item["ts"], "sid": ss.sid, "cust_id": CUST_ID, "type": "crm_handoff", **item})
+    ss.crm_queue.append(item)
 
 # ------------------ 규칙/유틸 ------------------
 def money(x):
     try: return f"{int(x):,}원"
     except: return str(x)
 
+@traced("card_png")
 @st.cache_data(show_spinner=False)
 def card_png_b64(title, color="#5B8DEF"):
     w,h = 300,180
@@ -210,99 +932,864 @@ def card_png_b64(title, color="#5B8DEF"):
     buf=io.BytesIO(); img.save(buf,format="PNG")
     return base64.b64encode(buf.getvalue()).decode()
 
+class CardIndex:
+    """MCC → 후보 카드(ALL 카드 병합) 인덱스 + 카드별 잔여 한도.
+    카드 구성(이름/MCC/적립률/한도)이 바뀔 때만 새로 만들고, month_accum 변화는 sync/update_accum으로 반영."""
+    def __init__(self, cards):
+        self.meta  = {c["name"]: c for c in cards}
+        self.order = [c["name"] for c in cards]   # 동점 시 보유 순서 유지(기존 정렬과 동일)
+        self.accum = {c["name"]: c["month_accum"] for c in cards}
+        self.remain = {c["name"]: max(0, c["cap"] - c["month_accum"]) for c in cards}
+        self.state_version = None
+        by_mcc, wild = defaultdict(list), []
+        for c in cards:
+            if "ALL" in c["mcc"]: wild.append(c["name"])
+            else:
+                for m in c["mcc"]: by_mcc[m].append(c["name"])
+        pos = {n:i for i,n in enumerate(self.order)}
+        self._wild = wild
+        self.by_mcc = {m: sorted(set(names + wild), key=pos.get) for m, names in by_mcc.items()}
+
+    @staticmethod
+    def version(cards)->str:
+        return fingerprint([(c["name"], c["mcc"], c["rate"], c["cap"]) for c in cards])
+
+    def candidates(self, mcc:str):
+        return self.by_mcc.get(mcc, self._wild)
+
+    def update_accum(self, name:str, month_accum:int):
+        c = self.meta[name]; self.accum[name] = month_accum
+        self.remain[name] = max(0, c["cap"] - month_accum)
+
+    def sync(self, cards, state_version):
+        """고객 상태 버전이 바뀌었을 때 month_accum이 달라진 카드만 갱신."""
+        for c in cards:
+            if self.accum.get(c["name"]) != c["month_accum"]: self.update_accum(c["name"], c["month_accum"])
+        self.state_version = state_version
+
+    def top(self, amount:int, mcc:str, k:int=3):
+        """절약액 상위 k(힙). 기존 선형 스캔(보유 순서로 채운 뒤 절약액 안정 정렬)과 같은 순서:
+        절약액 0인 자리는 적용 가능(한도 소진)·적용 불가 카드를 구분 없이 보유 순서로 채움."""
+        def row(name):
+            c, remain = self.meta[name], self.remain[name]
+            return (name, min(int(amount*c["rate"]), remain), f"{int(c['rate']*100)}% / 잔여 {remain:,}원")
+        cands = self.candidates(mcc)
+        top = [r for r in heapq.nlargest(k, map(row, cands), key=lambda x: x[1]) if r[1] > 0]
+        if len(top) < k:
+            used = set(cands)
+            for n in self.order:
+                if len(top) >= k: break
+                if n not in used: top.append((n, 0, "적용 불가"))
+                elif (r := row(n))[1] == 0: top.append(r)
+        return top
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _card_index(cust_id:str, version:str, _cards):
+    # 고객·카드 구성 버전별 1개(프로세스 공유). 잔여 한도는 상태 버전이 바뀔 때 sync
+    return CardIndex(_cards)
+
+def card_index()->CardIndex:
+    cards = CUSTOMER["owned_cards"]
+    pver = state_store().derived(SNAP, "card_portfolio", lambda: CardIndex.version(cards))
+    idx = _card_index(CUST_ID, pver, cards)
+    if idx.state_version != SNAP.version: idx.sync(cards, SNAP.version)
+    return idx
+
+@traced("estimate_saving")
 def estimate_saving(amount:int, mcc:str):
-    best=("현재카드 유지",0,"추가 혜택 없음"); board=[]
-    for c in CUSTOMER["owned_cards"]:
-        if "ALL" not in c["mcc"] and mcc not in c["mcc"]:
-            board.append((c["name"],0,"적용 불가")); continue
-        rate, cap, used = c["rate"], c["cap"], c["month_accum"]
-        remain = max(0, cap - used)
-        save = min(int(amount*rate), remain)
-        note = f"{int(rate*100)}% / 잔여 {remain:,}원"
-        board.append((c["name"], save, note))
-        if save > best[1]: best=(c["name"], save, note)
-    board.sort(key=lambda x:x[1], reverse=True)
-    return best, board[:3]
-
-def credit_utilization():
-    card = next(a for a in CUSTOMER["accounts"] if a["type"]=="신용카드")
-    return card["used"] / card["limit"]
-
-def budget_status():
-    over = []
-    for k,v in CUSTOMER["budgets"].items():
-        if v["spent"] > v["limit"] * 0.9:
-            over.append((k, v["spent"], v["limit"]))
-    return over
+    board = card_index().top(amount, mcc, k=3)
+    best = board[0] if board and board[0][1] > 0 else ("현재카드 유지",0,"추가 혜택 없음")
+    return best, board
+
+@traced("route_batch")
+def route_batch(tx:pd.DataFrame, cards=None)->pd.DataFrame:
+    """거래 표 전체를 한 번에 라우팅해 행마다 card/saving 컬럼을 붙여 반환(원래 행 순서 유지).
+    규칙: 날짜순으로, 적용 가능한 카드 중 적립률이 가장 높고 월 한도가 남은 카드에 결제(남은 만큼만 적립).
+    한도는 매월 초기화되며 이번 달만 현재 month_accum에서 시작. 한도가 거의 찬 카드의 부분 적립을
+    다른 카드의 전액 적립과 비교하지는 않으므로 그 경계에서는 estimate_saving과 다를 수 있음.
+    행 루프 없이 카드 수만큼만 반복하고 각 단계는 NumPy/pandas 벡터 연산."""
+    cards = CUSTOMER["owned_cards"] if cards is None else cards
+    out = tx.reset_index(drop=True)
+    order = np.argsort(out["date"].astype(str).to_numpy(), kind="stable")
+    amount = out["amount"].to_numpy(dtype=float)[order]
+    mcc    = out["mcc"].astype(str).to_numpy()[order]
+    month  = out["date"].astype(str).str[:7].to_numpy()[order]
+    this_month = time.strftime("%Y-%m")
+    n = len(out)
+    card_col, save_col, free = np.full(n, "현재카드 유지", dtype=object), np.zeros(n, dtype=np.int64), np.ones(n, dtype=bool)
+    for c in sorted(cards, key=lambda c: -c["rate"]):   # 동률이면 보유 순서
+        elig = free & (np.ones(n, dtype=bool) if "ALL" in c["mcc"] else np.isin(mcc, c["mcc"]))
+        if not elig.any(): continue
+        full = np.where(elig, np.floor(amount * c["rate"]), 0).astype(np.int64)
+        prev = pd.Series(full).groupby(month).cumsum().to_numpy() - full   # 같은 달 앞선 적립 누계
+        room = c["cap"] - np.where(month == this_month, c["month_accum"], 0) - prev
+        take = elig & (room > 0)
+        card_col[take] = c["name"]
+        save_col[take] = np.minimum(full, room)[take]
+        free &= ~take
+    out = out.copy()
+    out["card"], out["saving"] = card_col[np.argsort(order)], save_col[np.argsort(order)]
+    return out
+
+BATCH_COLS = ("date", "merchant", "amount")
+
+def read_tx_csv(src, merchants)->tuple:
+    """업로드 CSV → (route_batch용 표, 오류 문구). 천 단위 쉼표·'원' 허용, 날짜/금액이 안 읽히는 행은 제외."""
+    try:
+        df = pd.read_csv(src, thousands=",", dtype={"merchant": str, "mcc": str})
+    except (ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+        return None, f"CSV를 읽을 수 없어요: {e}"
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    missing = [c for c in BATCH_COLS if c not in df]
+    if missing: return None, f"필수 컬럼 없음: {', '.join(missing)} (필요: {', '.join(BATCH_COLS)}[, mcc])"
+    amount = pd.to_numeric(df["amount"].astype(str).str.replace(r"[,원\s]", "", regex=True), errors="coerce")
+    date = pd.to_datetime(df["date"], errors="coerce", format="mixed")
+    ok = amount.notna() & date.notna() & (amount >= 0)
+    if not ok.any(): return None, "날짜/금액을 읽을 수 있는 행이 없어요."
+    out = pd.DataFrame({"date": date[ok].dt.strftime("%Y-%m-%d"), "merchant": df.loc[ok, "merchant"].fillna("").astype(str),
+                        "amount": amount[ok].astype(np.int64)})
+    mcc = df.loc[ok, "mcc"] if "mcc" in df else pd.Series(np.nan, index=out.index)
+    out["mcc"] = mcc.fillna(out["merchant"].map(merchants)).fillna("ETC").astype(str)
+    skipped = int((~ok).sum())
+    return out.reset_index(drop=True), (f"{skipped:,}행은 날짜/금액 형식 오류로 제외" if skipped else None)
+
+# ------------------ 재무 스냅샷(상태 버전당 1회 계산) ------------------
+UTIL_FREE   = 0.3   # 이용률이 이 이상이면 초과분 1%p당 0.5점 감점
+BUDGET_WARN = 0.9   # 예산 대비 지출이 이 비율을 넘으면 경고(초과 시 더 크게 감점)
+
+def account(cust, kind:str):
+    """계정 유형(입출금/신용카드/…)의 첫 계정. mutate 드래프트에도 그대로 사용."""
+    return next((a for a in cust["accounts"] if a["type"]==kind), None)
+
+def budget_penalty(ratio:float)->int:
+    return 8 if ratio > 1 else 4 if ratio > BUDGET_WARN else 0
+
+class FinancialSnapshot:
+    """고객 상태 한 버전의 파생 지표: 유형별 계정 색인, 카드 이용률, 예산 비율, 건강 점수.
+    히어로·스냅샷·알림·LLM 컨텍스트가 모두 이 값을 읽음(계정 목록 재탐색 없음)."""
+    def __init__(self, cust):
+        self.accounts = {}
+        for a in cust["accounts"]: self.accounts.setdefault(a["type"], a)
+        self.card, self.deposit = self.accounts.get("신용카드"), self.accounts.get("입출금")
+        self.utilization = self.card["used"] / max(self.card["limit"], 1) if self.card else 0.0
+        self.low_balance = bool(self.deposit) and self.deposit["balance"] < self.deposit.get("low_alert", 0)
+        budgets = cust["budgets"]
+        self.budget_ratio = {k: v["spent"] / max(v["limit"], 1) for k,v in budgets.items()}
+        self.over_budget = [(k, v["spent"], v["limit"]) for k,v in budgets.items() if v["spent"] > v["limit"] * BUDGET_WARN]
+        score = 100 - int(max(0, (self.utilization - UTIL_FREE) * 100)) // 2
+        score -= 10 if self.low_balance else 0
+        score -= sum(budget_penalty(r) for r in self.budget_ratio.values())
+        self.score = max(0, min(100, score))
+
+    def context(self):
+        """LLM 컨텍스트용 요약(모델이 다시 계산하지 않게 결과만)."""
+        return {"score": self.score, "util": round(self.utilization, 3), "low_bal": self.low_balance,
+                "bud_ratio": {k: round(r, 2) for k,r in self.budget_ratio.items()}}
+
+@per_version
+def fin_snapshot()->FinancialSnapshot:
+    return FinancialSnapshot(CUSTOMER)
+
+def snapshot_frame(customers)->pd.DataFrame:
+    """여러 고객을 한 번에(상담사 대시보드용). FinancialSnapshot과 같은 규칙을 배열 연산으로."""
+    rows = []
+    for c in customers:
+        acc = {}
+        for a in c["accounts"]: acc.setdefault(a["type"], a)
+        card, dep = acc.get("신용카드") or {}, acc.get("입출금") or {}
+        rows.append((c["profile"]["cust_id"], card.get("used", 0), card.get("limit", 0),
+                     dep.get("balance", 0), dep.get("low_alert", 0), "입출금" in acc))
+    df = pd.DataFrame(rows, columns=["id","used","limit","balance","low_alert","has_dep"])
+    util = df["used"].to_numpy(float) / np.maximum(df["limit"].to_numpy(float), 1)
+    low = df["has_dep"].to_numpy() & (df["balance"].to_numpy() < df["low_alert"].to_numpy())
+    bud = pd.DataFrame([(i, v["spent"], v["limit"]) for i,c in enumerate(customers) for v in c["budgets"].values()],
+                       columns=["i","spent","limit"])
+    ratio = bud["spent"].to_numpy(float) / np.maximum(bud["limit"].to_numpy(float), 1)
+    pen = np.where(ratio > 1, 8, np.where(ratio > BUDGET_WARN, 4, 0))
+    bud_pen = np.bincount(bud["i"].to_numpy(int), weights=pen, minlength=len(df)).astype(int)
+    n_warn  = np.bincount(bud["i"].to_numpy(int), weights=ratio > BUDGET_WARN, minlength=len(df)).astype(int)
+    score = 100 - np.floor(np.maximum(0, (util - UTIL_FREE) * 100)).astype(int) // 2 - 10*low - bud_pen
+    return pd.DataFrame({"id": df["id"], "utilization": util, "low_balance": low,
+                         "budgets_over": n_warn, "score": np.clip(score, 0, 100)})
+
+class ScheduleIndex:
+    """일정을 날짜(ordinal) 순으로 정렬해 둔 인덱스. 기간 조회는 bisect로 O(log n + k)."""
+    def __init__(self, schedule):
+        rows = sorted((datetime.date.fromisoformat(x["date"]).toordinal(), i) for i,x in enumerate(schedule))
+        self.days  = [d for d,_ in rows]
+        self.items = [schedule[i] for _,i in rows]
+
+    def between(self, first:int, last:int):
+        lo, hi = bisect.bisect_left(self.days, first), bisect.bisect_right(self.days, last)
+        return self.items[lo:hi]
+
+@per_version
+def schedule_index():
+    return ScheduleIndex(CUSTOMER["schedule"])
 
 def due_within(days=7):
-    today = datetime.date.today()
-    alerts=[]
-    for s in CUSTOMER["schedule"]:
-        d = datetime.date.fromisoformat(s["date"])
-        if 0 <= (d - today).days <= days:
-            alerts.append(s)
-    return alerts
+    today = datetime.date.today().toordinal()
+    return schedule_index().between(today, today + days)
+
+# ------------------ 알림 엔진 ------------------
+DUE_ALERT_DAYS = 10
+
+def _alert_rules():
+    """(키, 종류, 문구) 목록. 키가 같으면 같은 알림으로 보고 세션당 한 번만 토스트."""
+    out, fs = [], fin_snapshot()
+    util = fs.utilization
+    if fs.low_balance: out.append((("low_balance",), "alert", f"입출금 잔액이 낮아요({money(fs.deposit['balance'])}). 예정 이체 확인."))
+    if util >= 0.8: out.append((("util_high",), "alert", f"신용카드 이용률 높음({util*100:.0f}%). 분할/유예 검토."))
+    for x in due_within(DUE_ALERT_DAYS):
+        out.append((("due", x["date"], x["title"]), "due", f"{x['title']}({x['date']})"))
+    return out
+
+def active_alerts():
+    # 규칙은 상태 버전(+날짜)이 바뀔 때만 다시 평가
+    today = datetime.date.today().isoformat()
+    return state_store().derived(SNAP, f"alerts@{today}", lambda: tuple(_alert_rules()))
+
+# ------------------ 캐시 ------------------
+class TTLCache:
+    """TTL + LRU 캐시(스레드 안전). hits/misses 카운터로 적중률 확인."""
+    def __init__(self, maxsize=128, ttl=600):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._d = OrderedDict(); self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._d.get(key)
+            if item is not None and time.time() - item[0] < self.ttl:
+                self._d.move_to_end(key); self.hits += 1
+                return item[1]
+            if item is not None: del self._d[key]   # 만료
+            self.misses += 1
+            return default
 
-def low_balance():
-    acc = next(a for a in CUSTOMER["accounts"] if a["type"]=="입출금")
-    return acc["balance"] < acc.get("low_alert", 0)
+    def put(self, key, value):
+        with self._lock:
+            self._d[key] = (time.time(), value); self._d.move_to_end(key)
+            while len(self._d) > self.maxsize: self._d.popitem(last=False)   # LRU 축출
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._d)}
+
+def fingerprint(*parts)->str:
+    """dict/list 등을 키 순서와 무관한 안정 해시로."""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+BRIEF_TTL = 15 * 60   # 데이터가 그대로여도 15분 지나면 재생성
+
+@st.cache_resource(show_spinner=False)
+def brief_cache():
+    # 프로세스 전역(세션 공유). 키 = 고객·상태 버전·거래 요약 지문이므로 세션 간 섞이지 않음
+    return TTLCache(maxsize=256, ttl=BRIEF_TTL)
+
+# ------------------ 목표 시뮬레이션(몬테카를로) ------------------
+GOAL_PATHS    = 4000       # 고객 1명당 시뮬레이션 경로 수
+GOAL_BANDS    = (10, 50, 90)
+GOAL_SPEND_CV = 0.15       # 월별 지출 이력이 부족할 때 변동성 = 예산 한도 합 × 이 비율
+GOAL_TTL      = 30 * 60
+GOAL_MAX_MONTHS = 120      # 시뮬레이션 기간 상한(경로 배열 P×H 메모리 상한)
+
+def months_until(iso:str, today=None)->int:
+    today = today or datetime.date.today()
+    d = datetime.date.fromisoformat(iso)
+    return max(0, (d.year - today.year) * 12 + d.month - today.month)
+
+def goal_base(cust, monthly_spend)->dict:
+    """목표와 무관한 고객별 입력: 현재 적립액, 적금 자동이체(만기까지), 지출 변동성, 예산 압박."""
+    g, sav = cust["goal"], account(cust, "적금")
+    limits = sum(v["limit"] for v in cust["budgets"].values())
+    spend = np.array(list(monthly_spend), float)
+    sigma = spend.std(ddof=1) if len(spend) >= 3 else limits * GOAL_SPEND_CV
+    # 경고선(BUDGET_WARN)을 넘긴 지출은 이번 달 저축 여력에서 빠진다고 보고 평균 초과 지출로 사용
+    pressure = sum(max(0, v["spent"] - v["limit"] * BUDGET_WARN) for v in cust["budgets"].values())
+    return {"start": g["target"] * g["progress"] / 100,
+            "committed": sav["monthly"] if sav else 0,
+            "commit_months": months_until(sav["maturity"]) if sav and sav.get("maturity") else 0,
+            "sigma": float(sigma), "pressure": float(pressure)}
+
+def goal_paths(target, months, monthly, start, committed, commit_months, sigma, pressure, paths=GOAL_PATHS, seed=0):
+    """고객 C명 × 경로 P개 × 최대 H개월 누적 적립액(C,P,H)을 한 번에. 인자는 스칼라 또는 길이 C 배열.
+    매달 저축 = 적금 자동이체(만기 전, 고정) + 나머지 계획 납입에서 초과 지출(정규 충격, 음수는 0)을 뺀 값."""
+    col = lambda x: np.asarray(x, float).reshape(-1, 1, 1)
+    target, monthly, start, sigma, pressure = map(col, (target, monthly, start, sigma, pressure))
+    months = np.clip(np.asarray(months, int).reshape(-1), 1, GOAL_MAX_MONTHS)
+    t = np.arange(months.max())
+    commit = np.where(t < col(commit_months), np.minimum(col(committed), monthly), 0)
+    # 큰 (C,P,H) 배열은 float32 한 벌만 만들고 제자리 연산(브로드캐스트 normal()보다 수 배 빠름)
+    x = np.random.default_rng(seed).standard_normal((len(months), paths, len(t)), dtype=np.float32)
+    x *= sigma; x += pressure; np.maximum(x, 0, out=x)                 # 초과 지출
+    np.subtract(monthly - commit, x, out=x); np.maximum(x, 0, out=x)   # 자유 납입
+    x += commit
+    np.cumsum(x, axis=2, out=x); x += start
+    return x, months, target
+
+def goal_summary(bal, months, target):
+    """(C,P,H) 경로 → 고객별 달성 확률, 마감 시점 백분위, 목표 도달 개월(중앙값, 미도달은 inf)."""
+    end = np.take_along_axis(bal, (months - 1).reshape(-1, 1, 1), axis=2)[..., 0]
+    hit = bal >= target
+    first = np.where(hit.any(axis=2), hit.argmax(axis=2) + 1, np.inf)
+    return (end >= target[..., 0]).mean(axis=1), np.percentile(end, GOAL_BANDS, axis=1), np.median(first, axis=1)
+
+@traced("goal.sim")
+def simulate_goal(target:int, months:int, monthly:int, base:dict, paths=GOAL_PATHS):
+    months = max(1, min(int(months), GOAL_MAX_MONTHS))
+    bal, m, tgt = goal_paths(target, months, monthly, paths=paths, **base)
+    prob, end, hit = goal_summary(bal, m, tgt)
+    bands = pd.DataFrame(np.percentile(bal[0], GOAL_BANDS, axis=0).T, columns=[f"p{q}" for q in GOAL_BANDS])
+    bands.index = pd.RangeIndex(1, months + 1, name="개월")
+    return {"prob": float(prob[0]), "bands": bands.round(-3), "hit_month": float(hit[0])}
+
+@st.cache_resource(show_spinner=False)
+def goal_cache():
+    # 키 = 목표 입력 + 고객 기반값 지문 → 슬라이더를 되돌리면 재계산 없이 바로 표시
+    return TTLCache(maxsize=512, ttl=GOAL_TTL)
+
+@per_version
+def goal_inputs()->dict:
+    return goal_base(CUSTOMER, TX_LOG.monthly_totals().values())
+
+def goal_projection(target:int, months:int, monthly:int)->dict:
+    base, months = goal_inputs(), max(1, min(int(months), GOAL_MAX_MONTHS))
+    key = fingerprint(target, months, monthly, base)
+    proj = goal_cache().get(key)
+    if proj is None:
+        proj = simulate_goal(target, months, monthly, base)
+        goal_cache().put(key, proj)
+    return proj
+
+def goal_frame(customers, spends=None, paths=1000, chunk=256, seed=0)->pd.DataFrame:
+    """여러 고객 목표 달성 확률을 한 번에(상담사 대시보드/배치). 메모리는 chunk×paths×H로 제한."""
+    spends = spends or [()] * len(customers)
+    rows = [{"target": c["goal"]["target"], "months": c["goal"]["months"], "monthly": c["goal"]["monthly"],
+             **goal_base(c, sp)} for c, sp in zip(customers, spends)]
+    df, out = pd.DataFrame(rows), []
+    for i in range(0, len(df), chunk):
+        part = df.iloc[i:i+chunk]
+        prob, end, hit = goal_summary(*goal_paths(**{k: part[k].to_numpy() for k in df}, paths=paths, seed=seed + i))
+        out.append(pd.DataFrame({"prob": prob, **{f"p{q}": end[j] for j,q in enumerate(GOAL_BANDS)}, "hit_month": hit}))
+    res = pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=["prob","hit_month"])
+    res.insert(0, "id", [c["profile"]["cust_id"] for c in customers])
+    return res
+
+# ------------------ 소비 인사이트(증분 집계) ------------------
+MCC_BUDGET   = {"FNB":"Dining", "CAFE":"Dining", "GROC":"Groceries", "TRNS":"Transport"}   # 업종 → 예산 항목
+INSIGHT_TOP  = 5
+ANOM_MIN_N   = 3          # 업종별 이 건수 이상 쌓여야 이상 거래 판정
+ANOM_Z       = 3.0        # 평균 + Z×표준편차 초과면 '큰 금액'
+ANOM_FLOOR   = 0.25       # 표준편차 하한 = 평균 × 이 비율(같은 금액만 있을 때 오탐 방지)
+ANOM_NEW_MERCHANT = 200_000   # 처음 보는 가맹점에서 이 금액 이상이면 표시
+ANOM_KEEP    = 50
+
+class InsightEngine:
+    """고객 1명의 거래를 한 건씩 누적(전체 재스캔 없음). sync()가 마지막 id 이후 거래만 읽어 반영.
+    업종: 건수·평균·분산(Welford) + 월별 합계, 가맹점: 건수·합계·최근일, 이상 거래는 반영 직전 통계로 판정."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.last_id = self.seq = 0
+        self.mcc = {}                            # mcc → [n, mean, M2]
+        self.months = defaultdict(lambda: defaultdict(int))   # "YYYY-MM" → mcc → 합계
+        self.merchants = {}                      # merchant → [n, 합계, 최근일]
+        self.flags = deque(maxlen=ANOM_KEEP)
+        self._summary = (None, None)
+
+    def _check(self, date, merchant, mcc, amount):
+        st_ = self.mcc.get(mcc)
+        if st_ and st_[0] >= ANOM_MIN_N:
+            n, mean, m2 = st_
+            std = max(math.sqrt(m2 / (n - 1)), mean * ANOM_FLOOR)
+            if amount > mean + ANOM_Z * std:
+                return (date, merchant, amount, f"{mcc} 평소 {money(mean)}의 {amount/max(mean,1):.1f}배")
+        if merchant not in self.merchants and amount >= ANOM_NEW_MERCHANT:
+            return (date, merchant, amount, "처음 보는 가맹점 고액")
+        return None
+
+    def add(self, date, merchant, mcc, amount):
+        flag = self._check(date, merchant, mcc, amount)
+        if flag: self.flags.append(flag)
+        st_ = self.mcc.setdefault(mcc, [0, 0.0, 0.0])
+        st_[0] += 1; d = amount - st_[1]; st_[1] += d / st_[0]; st_[2] += d * (amount - st_[1])
+        self.months[date[:7]][mcc] += amount
+        m = self.merchants.setdefault(merchant, [0, 0, date])
+        m[0] += 1; m[1] += amount; m[2] = max(m[2], date)
+        self.seq += 1
+        return flag
+
+    def sync(self, tx)->list:
+        """새 거래만 반영하고 이번에 새로 생긴 이상 거래 목록을 돌려줌."""
+        out = []
+        with self._lock:
+            for i, *row in tx.since(self.last_id):
+                flag = self.add(*row); self.last_id = i
+                if flag: out.append(flag)
+        return out
+
+    def summary(self, budgets, today=None)->dict:
+        """이번 달 업종 합계(직전 3개월 중 거래 있는 달 평균 대비), 상위 가맹점, 예산 소진 속도, 최근 이상 거래."""
+        today = today or datetime.date.today()
+        key = (self.seq, fingerprint(budgets), today)
+        with self._lock:
+            if self._summary[0] == key: return self._summary[1]
+            ym = today.strftime("%Y-%m")
+            first = today.replace(day=1)
+            prev = [(first - datetime.timedelta(days=28*i)).strftime("%Y-%m") for i in (1, 2, 3)]   # 직전 3개 달
+            prev = [m for m in prev if m in self.months]
+            cur = self.months.get(ym, {})
+            mcc = {k: [cur.get(k, 0), round(sum(self.months[m].get(k, 0) for m in prev) / max(len(prev), 1))]
+                   for k in sorted(set(cur) | {k for m in prev for k in self.months[m]})}
+            top = heapq.nlargest(INSIGHT_TOP, self.merchants.items(), key=lambda kv: kv[1][1])
+            # 이번 달 거래(업종 → 예산 항목)로 소진율. 경과 비율 대비(pace>1이면 이 속도로 월말 초과)
+            elapsed = today.day / ((today.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)).day
+            spent = defaultdict(int)
+            for k, amt in cur.items():
+                if MCC_BUDGET.get(k) in budgets: spent[MCC_BUDGET[k]] += amt
+            burn = {k: {"spent": spent[k], "ratio": round(spent[k] / max(v["limit"], 1), 2),
+                        "pace": round(spent[k] / max(v["limit"], 1) / elapsed, 2),
+                        "proj": int(spent[k] / elapsed)} for k, v in budgets.items()}
+            out = {"month": ym, "mtd": sum(cur.values()), "mcc": mcc,
+                   "top_m": [[m, n, amt] for m, (n, amt, _) in top], "burn": burn,
+                   "flags": [list(f) for f in list(self.flags)[-3:]]}
+            self._summary = (key, out)
+            return out
+
+@st.cache_resource(show_spinner=False)
+def insight_engine(cust_id:str)->InsightEngine:
+    # 고객별 1개(프로세스 전역). 첫 sync에서만 이력 전체를 읽고 이후엔 새 거래만
+    return InsightEngine()
+
+@traced("insight")
+def insights()->dict:
+    eng = insight_engine(CUST_ID)
+    eng.sync(TX_LOG)
+    return eng.summary(CUSTOMER["budgets"])
+
+# ------------------ 동시 실행 ------------------
+LLM_TIMEOUT = 25   # 호출별 기본 마감(초)
+
+@st.cache_resource(show_spinner=False)
+def llm_pool():
+    # 프로세스 공용. Gemini 호출은 네트워크 대기라 스레드로 충분
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+
+def submit(fn, *args):
+    """풀에서 실행. 현재 스크립트 컨텍스트를 붙여 st.cache_* 호출이 스레드에서도 동작하게."""
+    ctx = get_script_run_ctx()
+    def run():
+        if ctx: add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    return llm_pool().submit(run)
+
+def collect(fut, timeout=LLM_TIMEOUT, default=None):
+    try:
+        return fut.result(timeout=timeout)
+    except Exception:
+        fut.cancel()   # 대기 중이면 취소, 이미 실행 중이면 결과만 버림
+        return default
+
+def start_calls(calls:dict):
+    """{이름: (함수, 인자...)}를 동시에 보냄. gather로 수거."""
+    return time.monotonic(), {name: submit(fn, *args) for name, (fn, *args) in calls.items()}
+
+def gather(started, timeouts:dict|None=None, defaults:dict|None=None):
+    """호출별 마감(시작 시각 기준)까지 수거. calls의 키 순서로 모으므로 완료 순서와 무관하게 결정적."""
+    (t0, futs), timeouts, defaults = started, timeouts or {}, defaults or {}
+    out = {}
+    for name, fut in futs.items():
+        left = t0 + timeouts.get(name, LLM_TIMEOUT) - time.monotonic()
+        out[name] = collect(fut, max(0.0, left), defaults.get(name))
+    return out
+
+def fan_out(calls:dict, timeouts:dict|None=None, defaults:dict|None=None):
+    return gather(start_calls(calls), timeouts, defaults)
+
+# ------------------ 프롬프트 컨텍스트 ------------------
+# CUSTOMER 전체 대신 용도별로 필요한 섹션만, 키 약어 + 공백 없는 JSON으로
+KEY_ABBR = {
+    "type":"ty", "name":"n", "balance":"bal", "last_tx":"last", "low_alert":"low", "limit":"lim",
+    "used":"use", "statement_due":"due", "min_due":"min", "monthly":"mon", "maturity":"mat",
+    "rate":"r", "month_accum":"acc", "spent":"sp", "date":"d", "title":"t",
+    "amount":"amt", "target":"tgt", "months":"mo", "progress":"pct", "merchant":"m",
+}
+CTX_LEGEND = {v:k for k,v in KEY_ABBR.items()}
+
+CTX_SECTIONS = {   # 섹션명 → 원본 데이터(색상·마스킹 PII·고정 프로필 필드 제외)
+    "prof":  lambda: {k: CUSTOMER["profile"][k] for k in ("tier","age","city")},
+    "acc":   lambda: CUSTOMER["accounts"],
+    "cards": lambda: [{k:v for k,v in c.items() if k!="color"} for c in CUSTOMER["owned_cards"]],
+    "bud":   lambda: CUSTOMER["budgets"],
+    "sched": lambda: CUSTOMER["schedule"],
+    "goal":  lambda: {**CUSTOMER["goal"], "success_prob": round(goal_projection(
+                 CUSTOMER["goal"]["target"], CUSTOMER["goal"]["months"], CUSTOMER["goal"]["monthly"])["prob"], 2)},
+    "merch": lambda: CUSTOMER["merchants"],
+    "ins":   insights,   # 원시 거래 행 대신 증분 집계 요약
+    "snap":  lambda: fin_snapshot().context(),
+}
+REPLY_PLANS = (   # (키워드, 섹션) — 메시지에 걸리는 것만 합쳐서 보냄
+    (("결제","카드","한도","사용","혜택","가맹"), ("acc","snap","cards","merch","ins")),
+    (("예산","지출","소비","아껴","분석"),      ("bud","snap","ins")),
+    (("목표","적금","저축","여행"),             ("goal","acc")),
+    (("일정","납부","이체","언제"),             ("sched","acc")),
+)
+DEFAULT_SECTIONS = ("prof","acc","snap","bud","goal","sched")
+BRIEF_SECTIONS   = ("prof","acc","snap","cards","bud","sched","goal","ins")
+INTENT_SECTIONS  = ("merch","goal")
+EXPLAIN_SECTIONS = ("acc","sched")
+
+def reply_sections(user_msg:str):
+    secs = []
+    for keys, plan in REPLY_PLANS:
+        if any(k in user_msg for k in keys): secs += [x for x in plan if x not in secs]
+    return tuple(secs) or DEFAULT_SECTIONS
+
+def _abbr(x):
+    if isinstance(x, dict): return {KEY_ABBR.get(k,k): _abbr(v) for k,v in x.items()}
+    if isinstance(x, list): return [_abbr(v) for v in x]
+    return x
+
+@st.cache_resource(show_spinner=False)
+def ctx_blocks():
+    return TTLCache(maxsize=512, ttl=3600)
+
+def ctx_block(name:str, abbr:bool=True)->str:
+    """섹션 하나를 직렬화. 고객 상태 섹션은 스냅샷 버전, 인사이트는 데이터 지문이 같으면 이전 문자열 재사용."""
+    raw = CTX_SECTIONS[name]()
+    key = (name, abbr, fingerprint(raw) if name=="ins" else (CUST_ID, SNAP.version))
+    blk = ctx_blocks().get(key)
+    if blk is None:
+        blk = f"{name}=" + json.dumps(_abbr(raw) if abbr else raw, ensure_ascii=False, separators=(",",":"), default=str)
+        ctx_blocks().put(key, blk)
+    return blk
+
+def build_context(sections)->str:
+    body = "\n".join(ctx_block(n) for n in sections)
+    legend = ",".join(f"{a}={k}" for a,k in CTX_LEGEND.items() if f'"{a}"' in body)
+    short = (f"(키 약어: {legend})\n" if legend else "") + body
+    plain = "\n".join(ctx_block(n, abbr=False) for n in sections)
+    return short if len(short) < len(plain) else plain   # 작은 섹션은 범례가 더 길 수 있음
+
+def est_tokens(text:str)->int:
+    """대략적 토큰 추정(ASCII 4자≈1, 한글 등 1.5자≈1). 절감 비교용."""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return int((len(text) - non_ascii) / 4 + non_ascii / 1.5) + 1
+
+class TokenReport:
+    """호출명 → {"calls", "before", "after"} 추정 토큰 누계(풀 스레드에서도 갱신하므로 잠금).
+    예전 방식(전체 JSON 덤프) 기준치는 (호출, 고객, 상태 버전)당 한 번만 계산."""
+    def __init__(self):
+        self.rows, self._before, self._lock = {}, TTLCache(maxsize=256, ttl=3600), threading.Lock()
+
+    def add(self, call:str, legacy, after:int):
+        key = (call, CUST_ID, SNAP.version)
+        before = self._before.get(key)
+        if before is None:
+            before = est_tokens(json.dumps(legacy(), ensure_ascii=False, default=str))
+            self._before.put(key, before)
+        with self._lock:
+            row = self.rows.setdefault(call, {"calls":0, "before":0, "after":0})
+            row["calls"] += 1; row["before"] += before; row["after"] += after
+
+    def items(self):
+        with self._lock: return [(k, dict(v)) for k,v in self.rows.items()]
+
+    def __bool__(self): return bool(self.rows)
+
+@st.cache_resource(show_spinner=False)
+def token_report():
+    return TokenReport()
+
+def prompt_context(call:str, sections, legacy=None)->str:
+    """압축 컨텍스트를 만들고, 예전 방식 대비 토큰을 리포트에 누적. 실제 LLM 호출 직전에만 부를 것.
+    legacy: 비교 기준 데이터를 만드는 함수(기본은 고객 전체 + 최근 거래 20건)."""
+    ctx = build_context(sections)
+    token_report().add(call, legacy or (lambda: {"customer": CUSTOMER, "latest_transactions": TX_LOG.tail(20).to_dict("records")}),
+                       est_tokens(ctx))
+    return ctx
+
+# ------------------ 답변 캐시(정규화 + 근사 매칭) ------------------
+ANSWER_SIM_MIN = 0.88   # 3-gram 코사인 유사도 하한
+ANSWER_TTL = {"glossary": 7*24*3600, "intent": 24*3600, "cust": 30*60}
+ANSWER_APPROX = {"glossary"}   # 근사 매칭은 용어 설명만. 고객/의도 답은 '이번 달'↔'지난 달'처럼 한 단어로 뜻이 바뀜 → 정확 일치만
+_FILLER_RE = re.compile(r"(해주세요|해줘요|해줘|알려주세요|알려줘|부탁해요|부탁해|주세요|좀|요)$")
+_NUM_RE = re.compile(r"\d+")   # 근사 매칭에서도 숫자(금액·개월 등)는 정확히 같아야 함
+
+def normalize_query(text:str)->str:
+    """NFKC·소문자·구두점/공백 제거 후 말끝 군더더기 제거: '연금저축 설명해줘?' ≈ '연금저축설명'."""
+    base = t = re.sub(r"[^\w]+", "", unicodedata.normalize("NFKC", text).lower())
+    prev = None
+    while prev != t:
+        prev, t = t, _FILLER_RE.sub("", t)
+    return t or base   # 군더더기뿐인 입력('요')은 그대로(빈 키로 모이지 않게)
+
+def _trigrams(text:str)->dict:
+    t = f"^{text}$"
+    grams = defaultdict(int)
+    for i in range(max(1, len(t)-2)): grams[t[i:i+3]] += 1
+    return grams
+
+class AnswerCache:
+    """scope(용어/의도/고객 상태 버전)별 답변 캐시. 정규화 문자열 정확 일치 → 없으면 3-gram 역색인으로
+    후보만 골라 코사인 유사도 비교(approx=True로 넣고 찾을 때만, 숫자·금액이 모두 같은 후보만).
+    항목마다 TTL, 전체는 LRU로 maxsize 제한.
+    정규화 결과가 빈 문자열('?!')이면 캐시하지 않음."""
+    def __init__(self, maxsize=5000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()          # id → (scope, norm, vec, length, answer, expires, nums)
+        self._exact = {}                     # (scope, norm) → id
+        self._inv = defaultdict(set)         # (scope, gram) → {id}
+        self._lock, self._next = threading.Lock(), 0
+        self.hits_exact = self.hits_approx = self.misses = 0
+
+    def _drop(self, iid):
+        scope, norm, vec, *_ = self._items.pop(iid)
+        self._exact.pop((scope, norm), None)
+        for g in vec:
+            ids = self._inv.get((scope, g))
+            if ids:
+                ids.discard(iid)
+                if not ids: del self._inv[(scope, g)]
+
+    def get(self, scope:str, query:str, approx:bool=True):
+        norm, now = normalize_query(query), time.time()
+        with self._lock:
+            if not norm:
+                self.misses += 1; return None
+            iid = self._exact.get((scope, norm))
+            if iid is not None and self._items[iid][5] > now:
+                self._items.move_to_end(iid); self.hits_exact += 1
+                return self._items[iid][4]
+            if not approx:
+                self.misses += 1; return None
+            vec, nums = _trigrams(norm), _NUM_RE.findall(norm)
+            qlen = math.sqrt(sum(v*v for v in vec.values()))
+            cands = set().union(*(self._inv.get((scope, g), ()) for g in vec))
+            best, best_sim = None, 0.0
+            for cid in cands:
+                _, _, cvec, clen, _, exp, cnums = self._items[cid]
+                if exp <= now or cnums != nums: continue   # '12800원' ≠ '42800원'이면 다른 질문
+                sim = sum(v * cvec.get(g, 0) for g,v in vec.items()) / (qlen * clen)
+                if sim > best_sim: best, best_sim = cid, sim
+            if best is not None and best_sim >= ANSWER_SIM_MIN:
+                self._items.move_to_end(best); self.hits_approx += 1
+                return self._items[best][4]
+            self.misses += 1
+            return None
+
+    def put(self, scope:str, query:str, answer, ttl:float, approx:bool=True):
+        norm = normalize_query(query)
+        if not norm: return
+        vec = _trigrams(norm) if approx else {}   # 정확 일치 전용 항목은 3-gram 색인 안 함
+        length = math.sqrt(sum(v*v for v in vec.values()))
+        with self._lock:
+            old = self._exact.get((scope, norm))
+            if old is not None: self._drop(old)
+            iid, self._next = self._next, self._next + 1
+            self._items[iid] = (scope, norm, vec, length, answer, time.time() + ttl, _NUM_RE.findall(norm))
+            self._exact[(scope, norm)] = iid
+            for g in vec: self._inv[(scope, g)].add(iid)
+            while len(self._items) > self.maxsize: self._drop(next(iter(self._items)))
+
+    def stats(self):
+        return {"exact": self.hits_exact, "approx": self.hits_approx, "miss": self.misses, "size": len(self._items)}
+
+@st.cache_resource(show_spinner=False)
+def answer_cache():
+    return AnswerCache()
+
+def answer_scope(kind:str)->str:
+    # 고객 데이터에 기대는 답은 고객+상태 버전별, 용어 설명은 전역
+    if kind == "cust":   return f"cust:{CUST_ID}:v{SNAP.version}"
+    if kind == "intent": return f"intent:{CUST_ID}"
+    return kind
+
+def cached_answer(kind:str, query:str):
+    return answer_cache().get(answer_scope(kind), query, approx=kind in ANSWER_APPROX)
+
+def remember_answer(kind:str, query:str, answer):
+    if answer: answer_cache().put(answer_scope(kind), query, answer, ANSWER_TTL[kind], approx=kind in ANSWER_APPROX)
 
 # ------------------ LLM 유틸 ------------------
-def llm_reply(user_msg:str)->str:
-    context = {"customer": CUSTOMER, "latest_transactions": TX_LOG.tail(20).to_dict("records")}
+def _reply_prompt(user_msg:str)->str:
+    context = prompt_context("reply", reply_sections(user_msg))
     sys = (
         "너는 금융 코치이자 아바타. 아래 JSON을 사실 근거로 한국어로 간결하게 답해. "
         "개인정보는 그대로 복창하지 말고 필요한 범위만 요약. 3~6문장, 실행 제안 포함."
     )
-    prompt = f"{sys}\n\n# CUSTOMER_DATA\n{json.dumps(context, ensure_ascii=False)}\n\n# USER\n{user_msg}\n# ASSISTANT"
-    if not USE_LLM:
-        low = user_msg.lower()
-        if any(k in low for k in ["한도","카드","결제","사용"]):
-            a = next(x for x in CUSTOMER["accounts"] if x["type"]=="신용카드")
-            util = credit_utilization()*100
-            return f"카드 사용 {money(a['used'])} / 한도 {money(a['limit'])}(이용률 {util:.1f}%). 다음 납부일 {a['statement_due']}."
-        if "예산" in user_msg:
-            over = budget_status()
-            if over:
-                txt = " · ".join([f"{k} {money(s)} / {money(l)}" for k,s,l in over])
-                return f"예산 경고: {txt}. 필요 시 한도 조정/절약 플랜을 제안할게요."
-            return "예산은 아직 여유가 있어요."
-        return "무엇을 도와드릴까요? 예) “스타커피 12800원 결제 추천”, “이번달 예산 요약”."
+    return f"{sys}\n\n# CUSTOMER_DATA\n{context}\n\n# USER\n{user_msg}\n# ASSISTANT"
+
+def rule_reply(user_msg:str)->str:
+    """LLM 없이(키 없음/차단기 열림) 쓰는 규칙 기반 답변."""
+    low = user_msg.lower()
+    if any(k in low for k in ["한도","카드","결제","사용"]):
+        fs = fin_snapshot(); a = fs.card
+        return f"카드 사용 {money(a['used'])} / 한도 {money(a['limit'])}(이용률 {fs.utilization*100:.1f}%). 다음 납부일 {a['statement_due']}."
+    if "예산" in user_msg:
+        over = fin_snapshot().over_budget
+        if over:
+            txt = " · ".join([f"{k} {money(s)} / {money(l)}" for k,s,l in over])
+            return f"예산 경고: {txt}. 필요 시 한도 조정/절약 플랜을 제안할게요."
+        return "예산은 아직 여유가 있어요."
+    return "무엇을 도와드릴까요? 예) “스타커피 12800원 결제 추천”, “이번달 예산 요약”."
+
+@traced("llm.reply")
+def llm_reply(user_msg:str)->str:
+    if not llm_on(): return rule_reply(user_msg)
+    hit = cached_answer("cust", user_msg)
+    if hit is not None: return hit
     try:
-        res = MODEL.generate_content(prompt)
-        return (getattr(res,"text","") or "").strip()
+        res = MODEL.generate_content(_reply_prompt(user_msg))
+        reply = (getattr(res,"text","") or "").strip()
+        remember_answer("cust", user_msg, reply)
+        return reply
+    except LLMUnavailable:
+        return rule_reply(user_msg)
     except Exception as e:
         return f"[LLM 오류: {e}]"
 
+@traced("llm.intent")
 def llm_intent(user_msg:str):
-    if not USE_LLM:
+    if not llm_on():
         return {"tab":"home","actions":[],"arguments":{}}
+    hit = cached_answer("intent", user_msg)
+    if hit is not None: return hit
     try:
         sys = ("아래 고객 JSON을 참고해 사용자 의도를 JSON으로만 요약. "
                "필드: tab(home|pay|goal|calendar|insight), "
                "actions:[{{label, command, params}}], arguments:{{}}")
-        payload = {"customer": CUSTOMER, "latest_transactions": TX_LOG.tail(20).to_dict("records")}
-        prompt = f"{sys}\n\n# DATA\n{json.dumps(payload, ensure_ascii=False)}\n# USER\n{user_msg}\n# JSON ONLY"
+        payload = prompt_context("intent", INTENT_SECTIONS)
+        prompt = f"{sys}\n\n# DATA\n{payload}\n# USER\n{user_msg}\n# JSON ONLY"
         res = MODEL.generate_content(prompt, generation_config={"response_mime_type":"application/json"})
-        return json.loads(res.text)
+        intent = json.loads(res.text)
+        remember_answer("intent", user_msg, intent)
+        return intent
     except Exception:
         return {"tab":"home","actions":[],"arguments":{}}
 
+# 채팅 1턴 융합 호출용 스키마(의도·설명·상담 요약·답변)
+TURN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tab": {"type": "string", "enum": ["home","pay","goal","calendar","insight"]},
+        "explain": {"type": "string"},
+        "handoff_summary": {"type": "string"},
+        "reply": {"type": "string"},
+    },
+    "required": ["tab", "reply"],
+}
+
+def _turn_parts(user_msg:str, explain:bool, handoff:bool):
+    """융합 호출 공용: (컨텍스트, [(필드, 설명)])."""
+    sections = reply_sections(user_msg)
+    if explain: sections += tuple(x for x in EXPLAIN_SECTIONS if x not in sections)
+    fields = [("tab", "사용자 의도에 맞는 화면(home|pay|goal|calendar|insight)"),
+              ("reply", "3~6문장 답변, 실행 제안 포함")]
+    if explain:
+        fields.append(("explain", "accounts/schedule만 근거로 '왜/어떻게' 설명. 불확실하면 가정(가능성)으로 구분. 3~6문장, 실행 제안 1개"))
+    if handoff:
+        fields.append(("handoff_summary", "상담사 전달용 1~2문장 요약"))
+    return prompt_context("turn", sections), fields
+
+@traced("llm.turn")
+def llm_turn(user_msg:str, explain:bool=False, handoff:bool=False):
+    """llm_intent/llm_explain/핸드오프 요약/llm_reply를 한 번의 구조화 호출로. 실패 시 None(개별 경로로 폴백)."""
+    if not llm_on(): return None
+    if not (explain or handoff):   # 답변·의도가 모두 캐시에 있으면 호출 생략
+        reply, intent = cached_answer("cust", user_msg), cached_answer("intent", user_msg)
+        if reply is not None and intent is not None: return {"tab": intent.get("tab"), "reply": reply}
+    context, fields = _turn_parts(user_msg, explain, handoff)
+    sys = ("너는 금융 코치이자 아바타. 아래 JSON을 사실 근거로 한국어로 간결하게 답하고 결과는 JSON으로만. "
+           "개인정보는 그대로 복창하지 말고 필요한 범위만 요약.\n필드:\n- " + "\n- ".join(f"{k}: {v}" for k,v in fields))
+    prompt = f"{sys}\n\n# CUSTOMER_DATA\n{context}\n\n# USER\n{user_msg}\n# JSON ONLY"
+    try:
+        res = MODEL.generate_content(prompt, generation_config={
+            "response_mime_type":"application/json", "response_schema":TURN_SCHEMA})
+        out = json.loads(res.text)
+    except Exception:
+        return None
+    if not isinstance(out, dict) or not str(out.get("reply") or "").strip():
+        return None
+    remember_answer("cust", user_msg, out["reply"].strip())
+    remember_answer("intent", user_msg, {"tab": out.get("tab")})
+    return out
+
+_TURN_HEAD_RE = re.compile(r"^@(tab|reply|explain|handoff_summary)\b[ \t]*(.*)$")
+
+def parse_turn_text(text:str)->dict:
+    """'@필드' 머리줄로 나뉜 스트리밍 응답 → 필드 dict. 머리줄이 없으면 전체를 reply로."""
+    out, cur, pre = {}, None, []
+    for line in text.split("\n"):
+        m = _TURN_HEAD_RE.match(line.strip())
+        if m and m.group(1) == "tab":
+            out["tab"], cur = m.group(2).strip(), None
+        elif m:
+            cur = m.group(1); out[cur] = m.group(2)
+        elif cur:
+            out[cur] += ("\n" if out[cur] else "") + line
+        elif "tab" not in out:
+            pre.append(line)
+    if "reply" not in out and not text.lstrip().startswith("@"): out["reply"] = "\n".join(pre)
+    return out
+
+@traced("llm.turn_stream")
+def llm_turn_stream(user_msg:str, explain:bool, handoff:bool, turn:dict):
+    """llm_turn의 스트리밍판: 한 번의 호출로 reply 조각만 yield하고 tab/explain/요약은 turn에 채움.
+    JSON은 끝나야 읽을 수 있으므로 '@필드' 머리줄 텍스트 형식으로 받음. 실패 시 turn은 빈 dict(개별 경로로 폴백)."""
+    if not llm_on(): return
+    if not (explain or handoff):
+        reply, intent = cached_answer("cust", user_msg), cached_answer("intent", user_msg)
+        if reply is not None and intent is not None:
+            turn.update(tab=intent.get("tab"), reply=reply); yield reply; return
+    context, fields = _turn_parts(user_msg, explain, handoff)
+    sys = ("너는 금융 코치이자 아바타. 아래 JSON을 사실 근거로 한국어로 간결하게 답해. "
+           "개인정보는 그대로 복창하지 말고 필요한 범위만 요약.\n"
+           "출력 형식: 아래 순서대로 각 필드를 '@필드명' 머리줄로 시작(tab은 같은 줄에 값), 다른 머리말·JSON 금지.\n"
+           + "\n".join(f"@{k}{' <값>' if k == 'tab' else ''}  ← {v}" for k,v in fields))
+    prompt = f"{sys}\n\n# DATA\n{context}\n# USER\n{user_msg}"
+    text, sent = "", ""
+    try:
+        for chunk in MODEL.generate_content(prompt, stream=True):
+            text += getattr(chunk, "text", "") or ""
+            # 다음 머리줄일 수 있는 마지막 줄('@…')은 확정될 때까지 보류
+            reply = re.sub(r"\n[ \t]*@?\w*$", "", parse_turn_text(text).get("reply", ""))
+            if reply.startswith(sent) and len(reply) > len(sent):
+                yield reply[len(sent):]; sent = reply
+    except Exception:
+        if not sent: return
+    out = parse_turn_text(text)
+    reply = out.get("reply", "")
+    if reply.startswith(sent) and reply[len(sent):].strip(): yield reply[len(sent):].rstrip()   # 보류했던 끝부분
+    reply = reply.strip()
+    if not reply: return
+    turn.update({k: v.strip() for k,v in out.items()}, reply=reply)
+    remember_answer("cust", user_msg, reply)
+    remember_answer("intent", user_msg, {"tab": turn.get("tab")})
+
+@traced("llm.daily_brief")
 def llm_daily_brief():
-    if not USE_LLM:
+    if not llm_on():
         return "요약: 이용률/예산/납부일 확인. 액션: 납부일 확인, 결제 최적화, 목표 점검."
-    payload = {"customer": CUSTOMER, "latest_transactions": TX_LOG.tail(20).to_dict("records")}
+    # 고객 상태(버전)와 거래 요약이 그대로면 컨텍스트도 만들지 않고 캐시 재사용(홈 탭 리런마다 호출됨)
+    cache, key = brief_cache(), fingerprint(CUST_ID, SNAP.version, insights())
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    payload = prompt_context("brief", BRIEF_SECTIONS)
     sys = "너는 금융 코치. 데이터를 근거로 한 문단 요약과 다음 행동 3가지를 제시."
-    prompt = f"{sys}\n\n# DATA\n{json.dumps(payload, ensure_ascii=False)}\n# OUTPUT: 한국어, 4~6문장 + 불릿 3개"
+    prompt = f"{sys}\n\n# DATA\n{payload}\n# OUTPUT: 한국어, 4~6문장 + 불릿 3개"
     try:
         res = MODEL.generate_content(prompt)
-        return res.text.strip()
+        brief = res.text.strip()
+        cache.put(key, brief)   # 오류는 캐시하지 않음
+        return brief
     except Exception as e:
         return f"[요약 오류: {e}]"
 
+@traced("llm.parse_payment")
 def llm_parse_payment(free_text:str):
-    if not USE_LLM or not free_text.strip():
+    if not llm_on() or not free_text.strip():
         return None
     schema = ("JSON으로만. 필드: merchant(string), amount(int,원). "
               "merchant는 CUSTOMER.merchants 키 중 가장 유사한 값으로 매핑.")
@@ -314,30 +1801,226 @@ def llm_parse_payment(free_text:str):
     except Exception:
         return None
 
+@traced("llm.explain")
 def llm_explain(user_msg:str):
-    if not USE_LLM: return None
-    evidence = {"accounts": CUSTOMER["accounts"], "schedule": CUSTOMER["schedule"]}
+    if not llm_on(): return None
+    evidence = prompt_context("explain", EXPLAIN_SECTIONS,
+                              legacy=lambda: {"accounts": CUSTOMER["accounts"], "schedule": CUSTOMER["schedule"]})
     sys = ("아래 데이터만 근거로 '왜/어떻게' 질문을 설명. 불확실하면 가정(가능성)으로 구분. 3~6문장, 실행 제안 1개.")
-    prompt = f"{sys}\n# DATA\n{json.dumps(evidence, ensure_ascii=False)}\n# QUESTION\n{user_msg}\n# ANSWER:"
+    prompt = f"{sys}\n# DATA\n{evidence}\n# QUESTION\n{user_msg}\n# ANSWER:"
     try:
         res = MODEL.generate_content(prompt); return res.text.strip()
     except: return None
 
+@traced("llm.glossary")
 def llm_glossary(query:str):
-    if not USE_LLM: return None
+    if not llm_on(): return None
+    hit = cached_answer("glossary", query)   # 용어 설명은 고객과 무관 → 전 사용자 공유
+    if hit is not None: return hit
     sys = ("금융 초심자 눈높이로 쉬운 비유와 수치 예시 포함해 5줄 이내 요약. 필요시 주의점 1개.")
     prompt = f"{sys}\n용어/문구: {query}\n한국어로:"
     try:
-        res = MODEL.generate_content(prompt); return res.text.strip()
+        res = MODEL.generate_content(prompt); gloss = res.text.strip()
+        remember_answer("glossary", query, gloss)
+        return gloss
     except: return None
 
+# ------------------ 결제 입력 파싱(로컬 우선) ------------------
+_AMT_RE = re.compile(r"(\d[\d,]*(?:\.\d+)?)\s*(만|천|백)?")
+_AMT_UNIT = {"만":10_000, "천":1_000, "백":100, None:1}
+PARSE_CONF_MIN = 0.75   # 이보다 낮으면 LLM 보정
+
+def parse_amount_ko(text:str):
+    """'12,000' / '12800원' / '1.2만' / '1만2천' / '3천원' → 원 단위 int. 여러 개면 가장 큰 금액."""
+    found, cur, last_unit, last_end = [], 0, None, -2
+    for m in _AMT_RE.finditer(text):
+        try: val = float(m.group(1).replace(",", ""))
+        except ValueError: continue
+        unit = m.group(2)
+        joined = cur and m.start() - last_end <= 1 and _AMT_UNIT[unit] < _AMT_UNIT[last_unit]   # '1만 2천'
+        if not joined and cur: found.append(cur); cur = 0
+        cur += val * _AMT_UNIT[unit]
+        last_unit, last_end = unit, m.end()
+    if cur: found.append(cur)
+    return int(round(max(found))) if found else None
+
+def _norm(text:str)->str:
+    return re.sub(r"\s+", "", text).lower()
+
+def _bigrams(text:str):
+    return {text[i:i+2] for i in range(len(text)-1)} or {text}
+
+class MerchantIndex:
+    """가맹점명 2-gram 역색인. 후보만 골라 포함률·편집 유사도로 점수(0~1)."""
+    def __init__(self, names):
+        self.names = list(names)
+        self.inv = defaultdict(set)
+        for nm in self.names:
+            for g in _bigrams(_norm(nm)): self.inv[g].add(nm)
+
+    def match(self, text:str):
+        q = _norm(text)
+        if not q: return None, 0.0
+        qgrams = _bigrams(q)
+        cands = set().union(*(self.inv.get(g, ()) for g in qgrams))
+        tokens = text.split(); windows = tokens + [a+b for a,b in zip(tokens, tokens[1:])]
+        best, score = None, 0.0
+        for nm in sorted(cands):
+            key = _norm(nm)
+            if key in q: sc = 1.0
+            else:
+                grams = _bigrams(key)
+                sc = max([len(grams & qgrams) / len(grams)] +
+                         [difflib.SequenceMatcher(None, key, _norm(w)).ratio() for w in windows])
+            if sc > score: best, score = nm, sc
+        return best, score
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def merchant_index(version:str, _names):
+    return MerchantIndex(_names)
+
+@st.cache_resource(show_spinner=False)
+def parse_cache():
+    return TTLCache(maxsize=2048, ttl=24*3600)
+
+def parse_payment(raw:str)->dict:
+    """자유 입력 → {"merchant","amount","source"}. 로컬 파서가 확신 없을 때만 LLM, 확정/LLM 결과만 입력 문자열별 메모.
+    리런(금액 변경·토글)마다 같은 입력이 다시 들어와도 LLM은 입력당 최대 1회."""
+    names = list(CUSTOMER["merchants"].keys())
+    ver = fingerprint(names)
+    key = (ver, raw.strip())
+    hit = parse_cache().get(key)
+    if hit is not None: return hit
+    merchant, score = merchant_index(ver, names).match(raw)
+    amount = parse_amount_ko(raw)
+    out = {"merchant": merchant if score >= 0.5 else None, "amount": amount, "source": "local"}
+    if amount is None or score < PARSE_CONF_MIN:
+        # LLM 없음(키 없음·차단기 열림)의 미확정 결과는 공용 캐시에 넣지 않음 → LLM 되는 세션이 막히지 않게
+        if not llm_on(): return out
+        fix = llm_parse_payment(raw)
+        if not fix: return out   # LLM 실패는 메모하지 않음(다음 입력 때 재시도)
+        out = {"merchant": fix.get("merchant") or out["merchant"], "amount": fix.get("amount") or amount, "source": "llm"}
+    parse_cache().put(key, out)
+    return out
+
+# ------------------ TTS ------------------
+TTS_MEM_BYTES = 32 * 1024 * 1024               # 메모리 계층 상한
+TTS_DISK_DIR  = os.getenv("TTS_CACHE_DIR", "")   # 지정 시 디스크 계층 사용
+TTS_RETRY_SEC = 30                              # 합성 실패 후 재시도 간격
+
+def _synth_mp3(text:str, lang:str)->bytes:
+    from gtts import gTTS   # TTS를 처음 켤 때만 로드
+    buf = io.BytesIO(); gTTS(text=text, lang=lang).write_to_fp(buf)
+    return buf.getvalue()
+
+class AudioCache:
+    """(텍스트, 언어) 해시 → MP3 바이트. 메모리 LRU(바이트 상한) + 선택적 디스크.
+    합성은 백그라운드 풀에서, 같은 문장은 진행 중인 작업을 공유해 두 번 합성하지 않음."""
+    def __init__(self, max_bytes=TTS_MEM_BYTES, disk_dir=""):
+        self.max_bytes, self.disk_dir = max_bytes, disk_dir
+        self._d, self._size, self._lock = OrderedDict(), 0, threading.Lock()
+        self._pending, self._failed = {}, {}
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tts")
+        if disk_dir: os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(text:str, lang:str)->str:
+        return hashlib.sha1(f"{lang}\0{text}".encode()).hexdigest()
+
+    def _path(self, key): return os.path.join(self.disk_dir, f"{key}.mp3")
+
+    def _remember(self, key, data):
+        with self._lock:
+            if key in self._d: return
+            self._d[key] = data; self._size += len(data)
+            while self._size > self.max_bytes and len(self._d) > 1:
+                _, old = self._d.popitem(last=False); self._size -= len(old)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._d:
+                self._d.move_to_end(key); return self._d[key]
+        if self.disk_dir and os.path.exists(self._path(key)):
+            with open(self._path(key), "rb") as f: data = f.read()
+            self._remember(key, data); return data
+        return None
+
+    def _work(self, key, text, lang):
+        try:
+            data = _synth_mp3(text, lang)
+            self._remember(key, data)
+            if self.disk_dir:
+                tmp = self._path(key) + ".tmp"
+                with open(tmp, "wb") as f: f.write(data)
+                os.replace(tmp, self._path(key))
+        except Exception as e:
+            self._failed[key] = (time.time(), str(e))
+        finally:
+            with self._lock: self._pending.pop(key, None)
+
+    def request(self, text:str, lang:str="ko"):
+        """("ready", mp3) / ("pending", None) / ("error", 메시지). 없으면 합성을 걸어둠."""
+        key = self.key(text, lang)
+        data = self.get(key)
+        if data is not None: return "ready", data
+        failed = self._failed.get(key)
+        if failed and time.time() - failed[0] < TTS_RETRY_SEC: return "error", failed[1]
+        with self._lock:
+            if key not in self._pending:
+                self._failed.pop(key, None)
+                self._pending[key] = self._pool.submit(self._work, key, text, lang)
+        return "pending", None
+
+@st.cache_resource(show_spinner=False)
+def tts_cache():
+    return AudioCache(TTS_MEM_BYTES, TTS_DISK_DIR)
+
+@st.fragment(run_every=1.0)
+def _tts_wait(text:str):
+    # 합성 끝날 때까지 이 조각만 폴링. 준비되면 전체 리런 → 일반 경로에서 오디오 표시(폴링 종료)
+    state, _ = tts_cache().request(text)
+    if state == "pending": st.caption("🔊 음성 준비 중…")
+    else: st.rerun()
+
+@traced("tts")
 def tts_play(text:str):
-    try:
-        tts = gTTS(text=text, lang='ko')
-        buf = io.BytesIO(); tts.write_to_fp(buf)
-        st.audio(buf.getvalue(), format="audio/mp3")
-    except Exception as e:
-        st.warning(f"TTS 생성 실패: {e}")
+    state, data = tts_cache().request(text)
+    if state == "ready":
+        st.audio(data, format="audio/mp3")
+    elif state == "error":
+        st.warning(f"TTS 생성 실패: {data}")
+    else:
+        _tts_wait(text)
+
+def balloon_html(role:str, text:str)->str:
+    cls = "user" if role=="user" else ""
+    body = str(text).replace("\n", "<br>")   # 빈 줄이 HTML 블록을 끊지 않게
+    return f'<div class="msgbox"><div class="msg {cls}"><div class="balloon">{body}</div></div></div>'
+
+# ------------------ 대화 기록(윈도우 렌더 + 오래된 턴 보관) ------------------
+CHAT_PAGE = 20    # 한 번에 그리는/더 불러오는 메시지 수
+MSG_KEEP  = 200   # 세션 메모리에 남기는 최대 메시지 수(초과분은 저장소로)
+
+def trim_history():
+    over = len(ss.msgs) - MSG_KEEP
+    if over > 0:
+        chat_store().spill(ss.sid, ss.msgs_spilled, ss.msgs[:over])
+        del ss.msgs[:over]; ss.msgs_spilled += over
+
+def chat_window(n:int):
+    """최근 n개 메시지를 (seq, role, text)로. 메모리에 모자라면 저장소에서 보충."""
+    base = ss.msgs_spilled
+    win = [(base+i, r, t) for i,(r,t) in enumerate(ss.msgs)][-n:]
+    if len(win) < n and base > 0:
+        win = chat_store().page(ss.sid, base, n - len(win)) + win
+    return win
+
+def msg_html(seq:int, role:str, text:str)->str:
+    # 메시지는 추가만 되므로 seq별 HTML을 한 번 만들고 재사용
+    html = ss.msg_html.get(seq)
+    if html is None:
+        html = balloon_html(role, text); ss.msg_html.put(seq, html)
+    return html
 
 # ------------------ 상태 ------------------
 ss = st.session_state
@@ -345,293 +2028,483 @@ if "tab" not in ss: ss.tab="home"
 if "msgs" not in ss: ss.msgs=[("bot","어서 오세요. 어떤 금융 고민을 도와드릴까요?")]
 if "last_bot" not in ss: ss.last_bot = ss.msgs[-1][1]
 if "badges" not in ss: ss.badges=set()
-if "crm_queue" not in ss: ss.crm_queue=[]
-if "audit" not in ss: ss.audit=[]
+if "crm_queue" not in ss: ss.crm_queue=deque(maxlen=AUDIT_TAIL)
+if "audit" not in ss: ss.audit=deque(maxlen=AUDIT_TAIL)
+if "sid" not in ss: ss.sid = uuid.uuid4().hex
+if "alerts_seen" not in ss: ss.alerts_seen = set()
+if "msgs_spilled" not in ss: ss.msgs_spilled = 0
+if "chat_window" not in ss: ss.chat_window = CHAT_PAGE
+if "msg_html" not in ss: ss.msg_html = TTLCache(maxsize=MSG_KEEP*2, ttl=24*3600)
+trim_history()
+
+# ------------------ 화면 조각(프래그먼트)과 상태 의존성 ------------------
+FRAGMENT_READS = {}   # 프래그먼트 키 → 읽는 상태 조각(CUSTOMER 최상위 키 + 세션 조각)
+
+def region(key:str, reads):
+    """키 있는 st.fragment + 의존 조각 등록(reads는 집합 또는 지금 화면 기준 집합을 돌려주는 함수).
+    단독 리런이면 스냅샷을 최신으로 맞추고 계측 기록을 따로 남김. 콜백이 모아 둔 토스트는 먼저 도는 조각이 표시."""
+    FRAGMENT_READS[key] = reads if callable(reads) else set(reads)
+    def deco(fn):
+        @st.fragment(key=key)
+        @functools.wraps(fn)
+        def run():
+            partial = fragment_rerun()
+            if partial:
+                sync_snapshot(); begin_rerun(f"fragment:{key}")
+            try:
+                for msg, icon in ss.pop("toasts", []): st.toast(msg, icon=icon)
+                with span(f"frag.{key}"): fn()
+            finally:
+                if partial: end_rerun()
+        return run
+    return deco
+
+def fragment_reads(key:str)->set:
+    reads = FRAGMENT_READS[key]
+    return reads() if callable(reads) else reads
+
+def sync_snapshot():
+    """다른 세션/프로세스가 쓴 최신 버전으로(부분 리런은 모듈 최상단을 다시 돌지 않으므로)."""
+    global SNAP, CUSTOMER
+    cur = state_store().snapshot(CUST_ID)
+    if cur.version != SNAP.version: SNAP, CUSTOMER = cur, cur.data
+
+def notify(msg:str, icon:str):
+    """콜백 안에서는 요소를 그릴 수 없으므로 토스트를 모아 두었다가 다음에 도는 조각에서 표시."""
+    ss.setdefault("toasts", []).append((msg, icon))
+
+def redraw(before, touched=()):
+    """위젯 콜백 전용: before(변경 전 CUSTOMER) 이후 바뀐 조각을 읽는 프래그먼트만 다시 실행(전체 리런 없음)."""
+    changed = {k for k in CUSTOMER if CUSTOMER[k] != before.get(k)} | set(touched)
+    keys = [k for k in FRAGMENT_READS if fragment_reads(k) & changed]
+    if keys: st.rerun(keys)
+
+def go(tab:str):
+    ss.tab = tab; redraw(CUSTOMER, ("tab",))
+
+def _more_chat():
+    ss.chat_window += CHAT_PAGE; st.rerun(["chat"])
+
+def pay_now(merchant, mcc, amount, applied, saving):
+    def _pay(cust):
+        dep = account(cust, "입출금")
+        dep["balance"] = max(0, dep["balance"] - amount)
+        for c in cust["owned_cards"]:
+            if c["name"]==applied:
+                c["month_accum"] = min(c["cap"], c["month_accum"] + saving)
+    before, eng = CUSTOMER, insight_engine(CUST_ID)
+    eng.sync(TX_LOG)   # 이력 먼저 반영(과거 이상 거래는 토스트하지 않음)
+    TX_LOG.append({"date": time.strftime("%Y-%m-%d"), "merchant": merchant, "mcc": mcc, "amount": amount})
+    mutate(_pay)
+    for _, m, amt, why in eng.sync(TX_LOG):
+        notify(f"평소와 다른 결제: {m} {money(amt)} ({why})", "🔎")
+    ss.msgs.append(("bot", f"{merchant} {money(amount)} 결제 완료! 적용 {applied} · 절약 {money(saving)}"))
+    audit({"type":"payment", "merchant":merchant, "amount":amount, "applied":applied, "saving":saving})
+    if amount <= 10000: ss.badges.add("소액절약")
+    notify("결제가 완료되었습니다! (모의)", "✅")
+    redraw(before, ("tx","msgs","badges"))
+
+def save_goal(goal, target, months, monthly):
+    before = CUSTOMER
+    mutate(lambda cust: cust["goal"].update({"name":goal,"target":target,"months":months,"monthly":monthly}))
+    ss.msgs.append(("bot", f"'{goal}' 플랜 저장! 권장 월 납입 {money(monthly)}"))
+    audit({"type":"goal_update", "goal":goal, "monthly":monthly})
+    redraw(before, ("msgs",))
+
+def pay_min_due():
+    def _min_due(cust):
+        dep, card = account(cust, "입출금"), account(cust, "신용카드")
+        dep["balance"] = max(0, dep["balance"] - card["min_due"])
+        card["used"] = max(0, card["used"] - card["min_due"])
+    before = CUSTOMER
+    mutate(_min_due)
+    dep, card = fin_snapshot().deposit, fin_snapshot().card
+    ss.msgs.append(("bot", f"최소금 {money(card['min_due'])} 납부 처리(모의). 입출금 {money(dep['balance'])}"))
+    audit({"type":"min_due_paid", "amount":card["min_due"]})
+    notify("납부(모의) 완료!", "✅")
+    redraw(before, ("msgs",))
+
+def poc_balance():
+    def _poc(cust):
+        dep = account(cust, "입출금")
+        dep["balance"] = max(0, dep["balance"] - 50_000)
+    before = CUSTOMER
+    mutate(_poc); notify("입출금 잔액 변경.", "🔄"); redraw(before)
+
+def poc_card():
+    def _poc(cust):
+        account(cust, "신용카드")["used"] += 100_000
+    before = CUSTOMER
+    mutate(_poc); notify("카드 사용액 증가.", "🔄"); redraw(before)
+
+def poc_schedule():
+    today = datetime.date.today().isoformat()
+    before = CUSTOMER
+    mutate(lambda cust: cust["schedule"].append({"date":today,"title":"테스트 알림","amount":0}))
+    notify("오늘 일정 추가됨.", "📅"); redraw(before)
 
 # ------------------ 히어로(배경만: 아바타 제거) ------------------
-st.markdown("### ")
-with st.container():
-    st.markdown('<div class="hero">', unsafe_allow_html=True)
-    if hero_b64:
-        st.markdown(f'<img src="data:image/png;base64,{hero_b64}">', unsafe_allow_html=True)
-    else:
-        st.markdown("""
-        <div style="position:absolute;inset:0;
-             background:linear-gradient(135deg,#1b2140 0%,#0f182b 55%,#0a0f1a 100%);"></div>
-        """, unsafe_allow_html=True)
-    st.markdown('<div class="scrim"></div>', unsafe_allow_html=True)
-
-    # 칩/버블
-    prof = CUSTOMER["profile"]
-    chips = [
-        f"{prof['name']} · {prof['tier']}",
-        f"입출금 {money(next(a['balance'] for a in CUSTOMER['accounts'] if a['type']=='입출금'))}",
-        f"카드 사용 {money(next(a['used'] for a in CUSTOMER['accounts'] if a['type']=='신용카드'))}",
-        f"목표 {CUSTOMER['goal']['name']} {CUSTOMER['goal']['progress']}%"
-    ]
-    st.markdown('<div class="hero-content">', unsafe_allow_html=True)
-    for c in chips: st.markdown(f'<span class="chip">{c}</span>', unsafe_allow_html=True)
-    st.markdown('<div class="bubble">배경은 여기! 채팅에선 아바타가 옆에서 지켜봐요. 👀</div>', unsafe_allow_html=True)
-    st.markdown('</div></div>', unsafe_allow_html=True)
+@region("hero", reads={"profile","accounts","goal"})
+def hero():
+    st.markdown("### ")
+    with st.container():
+        st.markdown('<div class="hero">', unsafe_allow_html=True)
+        if hero_src:
+            st.markdown(f'<img src="{hero_src}">', unsafe_allow_html=True)
+        else:
+            st.markdown("""
+            <div style="position:absolute;inset:0;
+                 background:linear-gradient(135deg,#1b2140 0%,#0f182b 55%,#0a0f1a 100%);"></div>
+            """, unsafe_allow_html=True)
+        st.markdown('<div class="scrim"></div>', unsafe_allow_html=True)
+
+        # 칩/버블
+        prof, fs = CUSTOMER["profile"], fin_snapshot()
+        chips = [
+            f"{prof['name']} · {prof['tier']}",
+            f"입출금 {money(fs.deposit['balance'])}",
+            f"카드 사용 {money(fs.card['used'])}",
+            f"목표 {CUSTOMER['goal']['name']} {CUSTOMER['goal']['progress']}%"
+        ]
+        st.markdown('<div class="hero-content">', unsafe_allow_html=True)
+        for c in chips: st.markdown(f'<span class="chip">{c}</span>', unsafe_allow_html=True)
+        st.markdown('<div class="bubble">배경은 여기! 채팅에선 아바타가 옆에서 지켜봐요. 👀</div>', unsafe_allow_html=True)
+        st.markdown('</div></div>', unsafe_allow_html=True)
+
+# ------------------ 즉시 알림 ------------------
+@region("alerts", reads={"accounts","schedule"})
+def alerts():
+    _alerts = list(active_alerts())
+    if geo_sim:
+        _alerts.append((("geo",), "alert", "근처 '스타커피' 감지 → CAFE 가맹점 최적 카드 추천 활성."))
+    # 세션별 중복 제거: 새로 켜진 알림만 토스트, 조건이 풀리면 목록에서 빠져 다음에 다시 울릴 수 있음
+    _fresh = [(kind, msg) for key,kind,msg in _alerts if key not in ss.alerts_seen]
+    ss.alerts_seen = {key for key,_,_ in _alerts}
+    for kind, msg in _fresh:
+        if kind == "alert": st.toast(msg, icon="⚠️")
+    _due_new = [msg for kind,msg in _fresh if kind == "due"]
+    if _due_new: st.toast("다가오는 일정: " + " · ".join(_due_new), icon="⚠️")
 
 # ------------------ 네비 ------------------
-c1,c2,c3,c4 = st.columns(4)
-if c1.button("🏠 홈"): ss.tab="home"
-if c2.button("💳 결제"): ss.tab="pay"
-if c3.button("🎯 목표"): ss.tab="goal"
-if c4.button("📅 일정"): ss.tab="calendar"
-st.markdown(
-    f'<div class="navrow">'
-    f'<div class="navbtn {"active" if ss.tab=="home" else ""}">🏠 홈</div>'
-    f'<div class="navbtn {"active" if ss.tab=="pay" else ""}">💳 결제</div>'
-    f'<div class="navbtn {"active" if ss.tab=="goal" else ""}">🎯 목표</div>'
-    f'<div class="navbtn {"active" if ss.tab=="calendar" else ""}">📅 일정</div>'
-    f'</div>', unsafe_allow_html=True
-)
+TABS = (("home","🏠 홈"), ("pay","💳 결제"), ("goal","🎯 목표"), ("calendar","📅 일정"), ("insight","📊 분석"))
+TAB_READS = {   # 탭 본문이 읽는 CUSTOMER 최상위 키(+거래). 홈은 요약 프롬프트 때문에 거의 전부
+    "home":     {"profile","accounts","owned_cards","budgets","schedule","goal","tx"},
+    "pay":      {"owned_cards","merchants","tx"},
+    "goal":     {"goal","accounts","budgets","tx"},
+    "calendar": {"schedule"},
+    "insight":  {"budgets","tx"},
+}
 
-# ------------------ 즉시 알림 ------------------
-acc_dep = next(a for a in CUSTOMER["accounts"] if a["type"]=="입출금")
-card_acc = next(a for a in CUSTOMER["accounts"] if a["type"]=="신용카드")
-_util = credit_utilization()
-_alerts = []
-if low_balance(): _alerts.append(f"입출금 잔액이 낮아요({money(acc_dep['balance'])}). 예정 이체 확인.")
-if _util >= 0.8: _alerts.append(f"신용카드 이용률 높음({_util*100:.0f}%). 분할/유예 검토.")
-_due = due_within(10)
-if _due:
-    titles = " · ".join([f"{x['title']}({x['date']})" for x in _due])
-    _alerts.append(f"다가오는 일정: {titles}")
-if geo_sim:
-    _alerts.append("근처 '스타커피' 감지 → CAFE 가맹점 최적 카드 추천 활성.")
-for a in _alerts: st.toast(a, icon="⚠️")
-
-# ------------------ 본문 ------------------
-tab = ss.tab
-
-if tab=="home":
-    # 오늘의 요약
-    with st.expander("📌 오늘의 요약", expanded=True):
-        st.write(llm_daily_brief())
-
-    # ===== 채팅: 왼쪽 원형 아바타(스티키) + 오른쪽 말풍선 =====
-    st.markdown('<div class="section">', unsafe_allow_html=True)
-    st.markdown('<div class="label">대화</div>', unsafe_allow_html=True)
-    colL, colR = st.columns([1,6], gap="small")
-
-    with colL:
-        # 아바타 이미지 준비(원형)
-        if avatar_b64:
-            ava_src = f"data:image/png;base64,{avatar_b64}"
+@region("nav", reads={"tab"})
+def nav():
+    for col, (key, label) in zip(st.columns(len(TABS)), TABS):
+        col.button(label, on_click=go, args=(key,))
+    st.markdown('<div class="navrow">' + "".join(
+        f'<div class="navbtn {"active" if ss.tab==key else ""}">{label}</div>' for key, label in TABS) + '</div>',
+        unsafe_allow_html=True)
+
+# ------------------ 본문(탭) ------------------
+@region("body", reads=lambda: TAB_READS[ss.tab] | {"tab"})
+def body():
+    tab = ss.tab
+    # 오늘의 요약은 화면 그리는 동안 미리 요청(캐시 적중이면 즉시 끝남)
+    brief_fut = submit(llm_daily_brief) if tab=="home" else None
+
+    with span(f"tab.{tab}"):   # 탭 본문 렌더
+        if tab=="home":
+            # 오늘의 요약
+            with st.expander("📌 오늘의 요약", expanded=True):
+                brief = collect(brief_fut, default="[요약 지연: 잠시 후 다시 시도해 주세요]") if brief_fut else llm_daily_brief()
+                st.write(brief)
+                if USE_LLM:
+                    _bs = brief_cache().stats()
+                    st.caption(f"요약 캐시 hit {_bs['hits']} · miss {_bs['misses']} · {_bs['size']}건")
+
+            # 스냅샷
+            score = fin_snapshot().score
+
+            st.markdown('<div class="section" style="margin-top:10px;">', unsafe_allow_html=True)
+            st.markdown('<div class="label">금융 스냅샷</div>', unsafe_allow_html=True)
+            col1,col2,col3 = st.columns(3)
+            col1.metric("건강 점수", f"{score}/100")
+            col2.metric("카드 이용률", f"{fin_snapshot().utilization*100:.1f}%")
+            col3.metric("다음 납부", f"{fin_snapshot().card['statement_due']}")
+            st.markdown('</div>', unsafe_allow_html=True)
+
+            # 최근 거래
+            st.markdown('<div class="section" style="margin-top:10px;">', unsafe_allow_html=True)
+            st.markdown('<div class="label">최근 거래</div>', unsafe_allow_html=True)
+            st.dataframe(TX_LOG.tail(TX_VIEW_ROWS), height=220, use_container_width=True)
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        elif tab=="pay":
+            st.markdown('<div class="section">', unsafe_allow_html=True)
+            st.markdown('<div class="label">결제 입력</div>', unsafe_allow_html=True)
+
+            # 자연어 → 로컬 파싱(확신 낮을 때만 LLM 보정)
+            raw = st.text_input("자유 입력(예: 스타커피 12800 / 점심 1.2만)", value="")
+            merchant = None; amount = None
+            if raw.strip():
+                parsed = parse_payment(raw)
+                merchant, amount = parsed["merchant"], parsed["amount"]
+                st.caption(f"해석: {merchant or '?'} · {money(amount) if amount else '?'} ({'LLM 보정' if parsed['source']=='llm' else '로컬'})")
+
+            merchant = st.selectbox("가맹점", list(CUSTOMER["merchants"].keys()),
+                                    index=(list(CUSTOMER["merchants"].keys()).index(merchant) if merchant in CUSTOMER["merchants"] else 0))
+            amount = st.number_input("금액(원)", min_value=1000, value=int(amount) if amount else 12800, step=500)
+            auto   = st.toggle("자동결제 라우팅(최적 카드 자동선택)", value=True)
+            mcc = CUSTOMER["merchants"][merchant]
+            best, top3 = estimate_saving(int(amount), mcc)
+
+            st.markdown('<div class="label" style="margin-top:8px;">추천 카드 Top3</div>', unsafe_allow_html=True)
+            colA,colB,colC = st.columns(3)
+            for col,(nm,sv,nt) in zip([colA,colB,colC], top3):
+                color = card_index().meta[nm]["color"]
+                img64 = card_png_b64(nm, color)
+                with col:
+                    st.markdown(
+                        f'<div class="paycard"><img src="data:image/png;base64,{img64}" style="width:100%;border-radius:10px;"/>'
+                        f'<div style="font-weight:700;margin-top:6px">{nm}</div>'
+                        f'<div style="font-size:12px;opacity:.85">절약 {money(sv)}</div>'
+                        f'<div style="font-size:12px;opacity:.65">{nt}</div></div>', unsafe_allow_html=True
+                    )
+            st.info(f"결제 직전 최적화 결과 → **{best[0]}** · 예상 절약 {money(best[1])}")
+
+            st.button("✅ 결제 실행(모의)", use_container_width=True, on_click=pay_now,
+                      args=(merchant, mcc, int(amount), best[0] if auto else top3[0][0], best[1]))
+            st.markdown('</div>', unsafe_allow_html=True)
+
+            # 일괄 라우팅 리포트: "이 카드들로 결제했다면 얼마나 아꼈을까"
+            with st.expander("📊 일괄 라우팅 리포트"):
+                csv_up = st.file_uploader("거래 CSV(date, merchant, amount[, mcc])", type=["csv"])
+                batch = TX_LOG.tail(TX_VIEW_ROWS)
+                if csv_up:
+                    batch, problem = read_tx_csv(csv_up, CUSTOMER["merchants"])
+                    if batch is None: st.error(problem)
+                    elif problem: st.warning(problem)
+                if batch is not None and len(batch):
+                    routed = route_batch(batch)
+                    by_card = routed.groupby("card", sort=False)["saving"].agg(["count","sum"]).sort_values("sum", ascending=False)
+                    st.metric("예상 절약 합계", money(routed["saving"].sum()), help=f"{len(routed):,}건 기준")
+                    st.table(by_card.rename(columns={"count":"건수","sum":"절약"}))
+                    st.dataframe(routed.tail(TX_VIEW_ROWS), height=220, use_container_width=True)
+
+        elif tab=="goal":
+            g = CUSTOMER["goal"]
+            st.markdown('<div class="section">', unsafe_allow_html=True)
+            st.markdown('<div class="label">목표 설정</div>', unsafe_allow_html=True)
+            goal = st.text_input("목표 이름", value=g["name"])
+            c1,c2 = st.columns(2)
+            with c1:
+                target = st.number_input("목표 금액(원)", min_value=100000, value=int(g["target"]), step=100000)
+            with c2:
+                months = st.number_input("기간(개월)", min_value=1, max_value=GOAL_MAX_MONTHS,
+                                         value=min(int(g["months"]), GOAL_MAX_MONTHS))
+            monthly = math.ceil(target/max(months,1)/1000)*1000
+            st.button("목표 저장/갱신", use_container_width=True, on_click=save_goal,
+                      args=(goal, int(target), int(months), int(monthly)))
+
+            st.progress(min(g["progress"],100)/100, text=f"진행률 {g['progress']}%")
+            st.write(f"권장 월 납입: **{money(CUSTOMER['goal']['monthly'])}**")
+
+            # 입력값 기준 시뮬레이션(저장 전에도 미리보기). 같은 입력은 캐시에서 바로
+            proj = goal_projection(int(target), int(months), int(monthly))
+            m1,m2 = st.columns(2)
+            m1.metric("달성 확률", f"{proj['prob']*100:.0f}%", help=f"{GOAL_PATHS:,}개 경로 · 월 {money(monthly)} 납입 기준")
+            m2.metric("도달 예상", f"{proj['hit_month']:.0f}개월" if math.isfinite(proj["hit_month"]) else "기간 내 어려움")
+            st.line_chart(proj["bands"].assign(목표=int(target)), height=180)
+            st.caption(f"적립액 백분위({'/'.join(f'p{q}' for q in GOAL_BANDS)}) · 지출 변동과 예산 초과분을 반영")
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        elif tab=="insight":
+            # 증분 집계 요약만 그림(거래 이력 재조회 없음)
+            ins = insights()
+            st.markdown('<div class="section">', unsafe_allow_html=True)
+            st.markdown(f'<div class="label">{ins["month"]} 소비 분석</div>', unsafe_allow_html=True)
+            m1,m2 = st.columns(2)
+            m1.metric("이번 달 지출", money(ins["mtd"]))
+            m2.metric("이상 거래", f"{len(ins['flags'])}건")
+            if ins["mcc"]:
+                st.bar_chart(pd.DataFrame(ins["mcc"], index=["이번 달","직전 월평균"]).T, height=180, stack=False)
+            st.markdown('<div class="label" style="margin-top:8px;">예산 소진 속도</div>', unsafe_allow_html=True)
+            st.table(pd.DataFrame([{"예산": k, "이번 달": money(b["spent"]), "소진율": f"{b['ratio']*100:.0f}%", "속도": f"{b['pace']:.2f}x",
+                                    "월말 예상": money(b["proj"])} for k, b in ins["burn"].items()]))
+            if ins["top_m"]:
+                st.markdown('<div class="label">자주 쓰는 가맹점</div>', unsafe_allow_html=True)
+                st.table(pd.DataFrame(ins["top_m"], columns=["가맹점","건수","합계"]))
+            for d, m, amt, why in ins["flags"]:
+                st.warning(f"{d} {m} {money(amt)} — {why}", icon="🔎")
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        else:  # calendar
+            st.markdown('<div class="section">', unsafe_allow_html=True)
+            st.markdown('<div class="label">다가오는 일정</div>', unsafe_allow_html=True)
+            sched = pd.DataFrame(CUSTOMER["schedule"])
+            st.table(sched)
+
+            st.markdown('<div class="label" style="margin-top:8px;">빠른 액션</div>', unsafe_allow_html=True)
+            st.button("💳 이번 달 카드 최소금 납부(모의)", use_container_width=True, on_click=pay_min_due)
+            st.markdown('</div>', unsafe_allow_html=True)
+
+# ------------------ 대화(기록 + 입력 + TTS) ------------------
+@region("chat", reads={"msgs","tab"})
+def chat():
+    """홈에선 대화 기록, 모든 탭에서 입력창. 보내기는 이 조각만 다시 실행(탭·상담 큐가 바뀌면 전체)."""
+    trim_history()   # 콜백이 쌓은 메시지 포함, 조각 리런에서도 세션 메모리 상한 유지
+    stream_slot = None
+    if ss.tab=="home":
+        # ===== 채팅: 왼쪽 원형 아바타(스티키) + 오른쪽 말풍선 =====
+        st.markdown('<div class="section">', unsafe_allow_html=True)
+        st.markdown('<div class="label">대화</div>', unsafe_allow_html=True)
+        colL, colR = st.columns([1,6], gap="small")
+
+        with colL:
+            # 아바타 이미지 준비(원형)
+            ava_src = avatar_src or default_avatar_src()
+
+            st.markdown(f"""
+            <div class="chatDock">
+              <div class="avaWrap">
+                <img src="{ava_src}" />
+                <div class="onlineDot"></div>
+              </div>
+              <div class="avaName">{st.session_state.get("avatar_name","아바타 코치")}</div>
+            </div>
+            """, unsafe_allow_html=True)
+
+        with colR:
+            # 최근 창만 한 번의 markdown으로, 그 이전은 "더보기"로 페이지 단위 로드
+            total = ss.msgs_spilled + len(ss.msgs)
+            if total > ss.chat_window:
+                st.button(f"⬆️ 이전 대화 더보기 ({total - ss.chat_window}개)", on_click=_more_chat, use_container_width=True)
+            st.markdown("".join(msg_html(*m) for m in chat_window(ss.chat_window)), unsafe_allow_html=True)
+            stream_slot = st.empty()   # 스트리밍 답변이 그려질 자리
+
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    with st.form("msg_form", clear_on_submit=True):
+        c1,c2,c3 = st.columns([5,1,1])
+        with c1:
+            user_msg = st.text_input("메시지", label_visibility="collapsed",
+                placeholder="예) 금리 차이 왜 그래? / 스타커피 12800 결제 / 연금저축 설명 / 상담사 연결")
+        with c2:
+            sent = st.form_submit_button("보내기", use_container_width=True)
+        with c3:
+            edu = st.form_submit_button("📘용어", use_container_width=True)
+
+    if sent and user_msg.strip():
+        text, tab = user_msg.strip(), ss.tab
+        ss.msgs.append(("user", text))
+        want_explain = any(k in text for k in ["왜","이유","차이","달라졌","어떻게"])   # 설명형 질문 자동 보조
+        want_handoff = any(k in text for k in ["상담","핸드오프","콜백","지점"])       # 상담사 핸드오프 큐(PoC)
+        if stream_on and llm_on():
+            # 융합 호출 1회를 스트리밍: 답변만 말풍선에 흘려 쓰고 의도/설명/요약은 같은 응답에서
+            live = (stream_slot or st.empty()).container()
+            live.markdown(balloon_html("user", text), unsafe_allow_html=True)
+            bot, reply, turn = live.empty(), "", {}
+            for part in llm_turn_stream(text, want_explain, want_handoff, turn):
+                reply += part
+                bot.markdown(balloon_html("bot", reply + " ▌"), unsafe_allow_html=True)
+            turn = turn or None
         else:
-            av = Image.new("RGB",(200,200),(21,27,46)); d=ImageDraw.Draw(av)
-            d.ellipse((4,4,196,196), fill=(33,41,72))
-            d.text((80,86), "AVA", fill=(220,230,255))
-            buf=io.BytesIO(); av.save(buf,format="PNG")
-            ava_src = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
-
-        st.markdown(f"""
-        <div class="chatDock">
-          <div class="avaWrap">
-            <img src="{ava_src}" />
-            <div class="onlineDot"></div>
-          </div>
-          <div class="avaName">{st.session_state.get("avatar_name","아바타 코치")}</div>
-        </div>
-        """, unsafe_allow_html=True)
-
-    with colR:
-        for role, text in ss.msgs:
-            cls = "user" if role=="user" else ""
-            st.markdown(f'<div class="msgbox"><div class="msg {cls}"><div class="balloon">{text}</div></div></div>', unsafe_allow_html=True)
-
-    st.markdown('</div>', unsafe_allow_html=True)
-
-    # 스냅샷
-    score = 100
-    score -= int(max(0, (_util-0.3)*100))//2
-    if low_balance(): score -= 10
-    for k,v in CUSTOMER["budgets"].items():
-        ratio = v["spent"]/max(v["limit"],1)
-        if ratio>1: score -= 8
-        elif ratio>0.9: score -= 4
-    score = max(0, min(100, score))
-
-    st.markdown('<div class="section" style="margin-top:10px;">', unsafe_allow_html=True)
-    st.markdown('<div class="label">금융 스냅샷</div>', unsafe_allow_html=True)
-    col1,col2,col3 = st.columns(3)
-    col1.metric("건강 점수", f"{score}/100")
-    col2.metric("카드 이용률", f"{_util*100:.1f}%")
-    col3.metric("다음 납부", f"{card_acc['statement_due']}")
-    st.markdown('</div>', unsafe_allow_html=True)
-
-    # 최근 거래
-    st.markdown('<div class="section" style="margin-top:10px;">', unsafe_allow_html=True)
-    st.markdown('<div class="label">최근 거래</div>', unsafe_allow_html=True)
-    st.dataframe(TX_LOG, height=220, use_container_width=True)
-    st.markdown('</div>', unsafe_allow_html=True)
-
-elif tab=="pay":
-    st.markdown('<div class="section">', unsafe_allow_html=True)
-    st.markdown('<div class="label">결제 입력</div>', unsafe_allow_html=True)
-
-    # 자연어 → LLM 파싱(보정)
-    raw = st.text_input("자유 입력(예: 스타커피 12800 / 점심 1.2만)", value="")
-    merchant = None; amount = None
-    if raw.strip():
-        parts = raw.split()
-        for p in parts:
-            if p.replace(",","").isdigit(): amount = int(p.replace(",",""))
-        for nm in CUSTOMER["merchants"].keys():
-            if nm.replace(" ","") in raw.replace(" ",""): merchant = nm; break
-        fix = llm_parse_payment(raw)
-        if fix:
-            merchant = fix.get("merchant", merchant)
-            amount   = fix.get("amount", amount)
-
-    merchant = st.selectbox("가맹점", list(CUSTOMER["merchants"].keys()),
-                            index=(list(CUSTOMER["merchants"].keys()).index(merchant) if merchant in CUSTOMER["merchants"] else 0))
-    amount = st.number_input("금액(원)", min_value=1000, value=int(amount) if amount else 12800, step=500)
-    auto   = st.toggle("자동결제 라우팅(최적 카드 자동선택)", value=True)
-    mcc = CUSTOMER["merchants"][merchant]
-    best, top3 = estimate_saving(int(amount), mcc)
-
-    st.markdown('<div class="label" style="margin-top:8px;">추천 카드 Top3</div>', unsafe_allow_html=True)
-    colA,colB,colC = st.columns(3)
-    for col,(nm,sv,nt) in zip([colA,colB,colC], top3):
-        color = next(c["color"] for c in CUSTOMER["owned_cards"] if c["name"]==nm)
-        img64 = card_png_b64(nm, color)
-        with col:
-            st.markdown(
-                f'<div class="paycard"><img src="data:image/png;base64,{img64}" style="width:100%;border-radius:10px;"/>'
-                f'<div style="font-weight:700;margin-top:6px">{nm}</div>'
-                f'<div style="font-size:12px;opacity:.85">절약 {money(sv)}</div>'
-                f'<div style="font-size:12px;opacity:.65">{nt}</div></div>', unsafe_allow_html=True
-            )
-    st.info(f"결제 직전 최적화 결과 → **{best[0]}** · 예상 절약 {money(best[1])}")
-
-    if st.button("✅ 결제 실행(모의)", use_container_width=True):
-        applied = best[0] if auto else top3[0][0]
-        TX_LOG.loc[len(TX_LOG)] = {"date": time.strftime("%Y-%m-%d"), "merchant": merchant, "mcc": mcc, "amount": int(amount)}
-        dep = next(a for a in CUSTOMER["accounts"] if a["type"]=="입출금")
-        dep["balance"] = max(0, dep["balance"] - int(amount))
-        for c in CUSTOMER["owned_cards"]:
-            if c["name"]==applied:
-                c["month_accum"] = min(c["cap"], c["month_accum"] + best[1])
-        ss.msgs.append(("bot", f"{merchant} {money(amount)} 결제 완료! 적용 {applied} · 절약 {money(best[1])}"))
-        ss.audit.append({"ts": time.time(), "type":"payment", "merchant":merchant, "amount":int(amount), "applied":applied, "saving":best[1]})
-        if amount <= 10000: ss.badges.add("소액절약")
-        st.success("결제가 완료되었습니다! (모의)")
-        st.rerun()
-    st.markdown('</div>', unsafe_allow_html=True)
-
-elif tab=="goal":
-    g = CUSTOMER["goal"]
-    st.markdown('<div class="section">', unsafe_allow_html=True)
-    st.markdown('<div class="label">목표 설정</div>', unsafe_allow_html=True)
-    goal = st.text_input("목표 이름", value=g["name"])
-    c1,c2 = st.columns(2)
-    with c1:
-        target = st.number_input("목표 금액(원)", min_value=100000, value=int(g["target"]), step=100000)
-    with c2:
-        months = st.number_input("기간(개월)", min_value=1, value=int(g["months"]))
-    monthly = math.ceil(target/max(months,1)/1000)*1000
-    if st.button("목표 저장/갱신", use_container_width=True):
-        CUSTOMER["goal"].update({"name":goal,"target":int(target),"months":int(months),"monthly":int(monthly)})
-        ss.msgs.append(("bot", f"'{goal}' 플랜 저장! 권장 월 납입 {money(monthly)}"))
-        ss.audit.append({"ts":time.time(), "type":"goal_update", "goal":goal, "monthly":int(monthly)})
-        st.rerun()
-
-    st.progress(min(g["progress"],100)/100, text=f"진행률 {g['progress']}%")
-    st.write(f"권장 월 납입: **{money(CUSTOMER['goal']['monthly'])}**")
-    st.markdown('</div>', unsafe_allow_html=True)
-
-else:  # calendar
-    st.markdown('<div class="section">', unsafe_allow_html=True)
-    st.markdown('<div class="label">다가오는 일정</div>', unsafe_allow_html=True)
-    sched = pd.DataFrame(CUSTOMER["schedule"])
-    st.table(sched)
-
-    st.markdown('<div class="label" style="margin-top:8px;">빠른 액션</div>', unsafe_allow_html=True)
-    if st.button("💳 이번 달 카드 최소금 납부(모의)", use_container_width=True):
-        dep = next(a for a in CUSTOMER["accounts"] if a["type"]=="입출금")
-        card = next(a for a in CUSTOMER["accounts"] if a["type"]=="신용카드")
-        dep["balance"] = max(0, dep["balance"] - card["min_due"])
-        card["used"] = max(0, card["used"] - card["min_due"])
-        ss.msgs.append(("bot", f"최소금 {money(card['min_due'])} 납부 처리(모의). 입출금 {money(dep['balance'])}"))
-        ss.audit.append({"ts":time.time(), "type":"min_due_paid", "amount":card["min_due"]})
-        st.success("납부(모의) 완료!")
-        st.rerun()
-    st.markdown('</div>', unsafe_allow_html=True)
-
-# ------------------ 입력(대화) ------------------
-with st.form("msg_form", clear_on_submit=True):
-    c1,c2,c3 = st.columns([5,1,1])
-    with c1:
-        user_msg = st.text_input("메시지", label_visibility="collapsed",
-            placeholder="예) 금리 차이 왜 그래? / 스타커피 12800 결제 / 연금저축 설명 / 상담사 연결")
-    with c2:
-        sent = st.form_submit_button("보내기", use_container_width=True)
-    with c3:
-        edu = st.form_submit_button("📘용어", use_container_width=True)
-
-if sent and user_msg.strip():
-    text = user_msg.strip()
-    ss.msgs.append(("user", text))
-    # 인텐트 → 탭/액션 힌트
-    hint = llm_intent(text)
-    if hint.get("tab") in {"home","pay","goal","calendar","insight"}:
-        ss.tab = "home" if hint["tab"]=="insight" else hint["tab"]
-    # 설명형 질문 자동 보조
-    if any(k in text for k in ["왜","이유","차이","달라졌","어떻게"]):
-        ex = llm_explain(text)
-        if ex: ss.msgs.append(("bot", ex))
-    # 상담사 핸드오프 큐(PoC)
-    if any(k in text for k in ["상담","핸드오프","콜백","지점"]):
-        summary = llm_reply("요약:"+text) if USE_LLM else text[:120]
-        ss.crm_queue.append({"ts":time.time(),"topic":text,"summary":summary,"status":"대기"})
-        st.toast("상담사 연결 요청을 접수했어요(모의).", icon="☎️")
-    # 일반 답변
-    reply = llm_reply(text)
-    ss.msgs.append(("bot", reply))
-    ss.last_bot = reply
-    st.rerun()
-
-if edu:
-    term = st.session_state.get("last_user_term","연금저축")
-    gloss = llm_glossary(term) or "용어 설명을 불러올 수 없습니다."
-    ss.msgs.append(("bot", f"[용어설명] {gloss}"))
-    ss.last_bot = gloss
-    st.rerun()
+            # 융합 호출 1회 → 실패/규칙 모드면 기존 개별 호출 경로
+            turn = llm_turn(text, want_explain, want_handoff)
+        if turn is None:   # 개별 호출은 서로 독립 → 동시에 보내 가장 느린 호출만큼만 대기
+            calls = {"intent": (llm_intent, text), "reply": (llm_reply, text)}
+            if want_explain: calls["explain"] = (llm_explain, text)
+            if want_handoff and llm_on(): calls["handoff_summary"] = (llm_reply, "요약:"+text)
+            turn = fan_out(calls, defaults={"intent": {}, "reply": "답변이 지연되고 있어요. 잠시 후 다시 시도해 주세요."})
+            turn["tab"] = (turn.pop("intent") or {}).get("tab")
+        # 인텐트 → 탭/액션 힌트
+        if turn.get("tab") in dict(TABS):
+            ss.tab = turn["tab"]
+        if want_explain and turn.get("explain"):
+            ss.msgs.append(("bot", turn["explain"]))
+        if want_handoff:
+            summary = turn.get("handoff_summary") or text[:120]
+            crm_handoff({"ts":time.time(),"topic":text,"summary":summary,"status":"대기"})
+            notify("상담사 연결 요청을 접수했어요(모의).", "☎️")
+        # 일반 답변
+        reply = turn["reply"]
+        ss.msgs.append(("bot", reply))
+        ss.last_bot = reply
+        trim_history()
+        rerun("app" if ss.tab != tab or want_handoff else "fragment")   # 다른 조각이 읽는 탭/큐가 바뀌었으면 전체
+
+    if edu:
+        term = st.session_state.get("last_user_term","연금저축")
+        gloss = llm_glossary(term) or "용어 설명을 불러올 수 없습니다."
+        ss.msgs.append(("bot", f"[용어설명] {gloss}"))
+        ss.last_bot = gloss
+        trim_history()
+        rerun("fragment")
+
+    # 마지막 봇 답변 TTS
+    if tts_on and ss.last_bot:
+        tts_play(ss.last_bot)
 
 # ------------------ 하단 PoC 컨트롤/배지/큐 ------------------
-st.markdown('<div class="section" style="margin-top:8px;">', unsafe_allow_html=True)
-st.markdown('<div class="label">PoC 컨트롤</div>', unsafe_allow_html=True)
-colA,colB,colC = st.columns(3)
-if colA.button("⬇️ 잔액 -50,000"):
-    dep = next(a for a in CUSTOMER["accounts"] if a["type"]=="입출금")
-    dep["balance"] = max(0, dep["balance"] - 50_000); st.toast("입출금 잔액 변경.", icon="🔄"); st.rerun()
-if colB.button("⬆️ 카드사용 +100,000"):
-    card = next(a for a in CUSTOMER["accounts"] if a["type"]=="신용카드")
-    card["used"] += 100_000; st.toast("카드 사용액 증가.", icon="🔄"); st.rerun()
-if colC.button("🔔 오늘 일정 추가"):
-    today = datetime.date.today().isoformat()
-    CUSTOMER["schedule"].append({"date":today,"title":"테스트 알림","amount":0})
-    st.toast("오늘 일정 추가됨.", icon="📅"); st.rerun()
-
-# 배지 표시
-if ss.badges:
-    st.markdown('<div class="section" style="margin-top:8px;">', unsafe_allow_html=True)
-    st.markdown('<div class="label">획득 배지</div>', unsafe_allow_html=True)
-    st.markdown(" ".join([f"<span class='badge'>{b}</span>" for b in sorted(ss.badges)]), unsafe_allow_html=True)
-
-# 상담 큐 표시
-if ss.crm_queue:
+@region("ops", reads={"badges","crm"})
+def ops():
     st.markdown('<div class="section" style="margin-top:8px;">', unsafe_allow_html=True)
-    st.markdown('<div class="label">상담사 핸드오프 큐(모의)</div>', unsafe_allow_html=True)
-    st.table(pd.DataFrame(ss.crm_queue))
-
-# 마지막 봇 답변 TTS
-if tts_on and ss.last_bot:
-    tts_play(ss.last_bot)
+    st.markdown('<div class="label">PoC 컨트롤</div>', unsafe_allow_html=True)
+    colA,colB,colC = st.columns(3)
+    colA.button("⬇️ 잔액 -50,000", on_click=poc_balance)
+    colB.button("⬆️ 카드사용 +100,000", on_click=poc_card)
+    colC.button("🔔 오늘 일정 추가", on_click=poc_schedule)
+
+    # 배지 표시
+    if ss.badges:
+        st.markdown('<div class="section" style="margin-top:8px;">', unsafe_allow_html=True)
+        st.markdown('<div class="label">획득 배지</div>', unsafe_allow_html=True)
+        st.markdown(" ".join([f"<span class='badge'>{b}</span>" for b in sorted(ss.badges)]), unsafe_allow_html=True)
+
+    # 상담 큐 표시
+    if ss.crm_queue:
+        st.markdown('<div class="section" style="margin-top:8px;">', unsafe_allow_html=True)
+        st.markdown('<div class="label">상담사 핸드오프 큐(모의)</div>', unsafe_allow_html=True)
+        st.table(pd.DataFrame(list(ss.crm_queue)))
+
+# ------------------ 페이지 ------------------
+hero()
+alerts()
+nav()
+body()
+chat()
+ops()
+
+# 성능 패널: 이번 리런까지 마감한 뒤 최근 N회 단계별 내역 + 전역 백분위
+end_rerun()
+if st.sidebar.toggle("성능 패널(디버그)", value=False):
+    with st.sidebar.expander(f"최근 {TRACE_RERUNS}회 리런(ms)", expanded=True):
+        rows = []
+        for r in reversed(ss.trace_runs):
+            stages = dict(r["stages"])
+            rows.append({"#": r["run"], "종류": r["kind"], "총": round(r["total"]*1000),
+                         "기타": round(max(0.0, r["total"] - r["covered"]) * 1000),
+                         **{k: round(v*1000) for k,v in sorted(stages.items())}})
+        st.dataframe(pd.DataFrame(rows).fillna(0), hide_index=True)
+        st.table(pd.DataFrame(tracer().summary()).fillna(""))
+        st.download_button("Prometheus 텍스트", tracer().prometheus(), "coach_metrics.prom", "text/plain")
+        st.download_button("리런 JSONL", "".join(json.dumps({k:v for k,v in r.items() if k not in ("t0", "thread")}, ensure_ascii=False) + "\n"
+                                               for r in ss.trace_runs), "coach_reruns.jsonl", "application/json")
+
+# 프롬프트 토큰 리포트(예전 전체 덤프 대비 추정치)
+_au = audit_sink().stats()
+if _au["error"] or _au["dropped"]:
+    st.sidebar.error(f"감사 로그 쓰기 실패 · 대기 {_au['pending']}건 · 폐기 {_au['dropped']}건" + (f" ({_au['error']})" if _au["error"] else ""))
+if USE_LLM:
+    _gs = MODEL.stats()
+    st.sidebar.caption(f"LLM 게이트웨이 {_gs['state']} · 호출 {_gs['calls']} · 재시도 {_gs['retries']} · 거절 {_gs['rejected']}")
+    if not MODEL.available(): st.sidebar.warning("LLM 응답 불안정 → 잠시 규칙 기반 답변으로 전환")
+    _as = answer_cache().stats()
+    st.sidebar.caption(f"답변 캐시 정확 {_as['exact']} · 근사 {_as['approx']} · 미스 {_as['miss']} · {_as['size']}건")
+if USE_LLM and token_report():
+    with st.sidebar.expander("프롬프트 토큰 리포트"):
+        st.table(pd.DataFrame([
+            {"호출": k, "횟수": v["calls"], "이전/회": v["before"]//v["calls"], "현재/회": v["after"]//v["calls"],
+             "절감": f"{100 - 100*v['after']/max(v['before'],1):.0f}%"}
+            for k,v in token_report().items()]))
 
 # 동의 안내
 st.markdown('<div class="smallnote">※ 개인화 기능은 고객 동의(마케팅/개인화)에 기반한 데모입니다. 실제 서비스 연동 시 감사 로그/민감정보 마스킹을 준수하세요.</div>', unsafe_allow_html=True)